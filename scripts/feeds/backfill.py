@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Re-enqueue documents already uploaded by upload.py, for reprocessing
+after changes to SCIO (new NLP models, tools.cfg, aliases.cfg etc.).
+
+Documents are selected from the 'upload' table of the upload cache by
+date range (creation-date), source and/or digest, and put on the work
+queue with their original .meta data, routed by language and size class
+the same way upload.py routes live ingest. The rate is limited, and no
+job is put while its tube holds more than --max-ready ready jobs, so live
+ingest is not starved. Documents are pre-tagged with the current
+gazetteer files, as in upload.py. Progress is checkpointed together with
+the filters; an interrupted backfill continues where it stopped, and a
+checkpoint from a backfill with other filters is not resumed.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import pystalkd.Beanstalkd
+
+from gazetteer import Gazetteer, html_to_text
+from jobpolicy import JobPolicy
+from language import detect_language
+from manifest import Checkpoint
+from packstore import PackStore
+from upload import choose_queue, document_language, pretag
+
+LOGGER = logging.getLogger('root')
+
+
+def init():
+    """initialize argument parser"""
+
+    parser = argparse.ArgumentParser(
+        description="Re-enqueue uploaded documents to Scio")
+    parser.add_argument("-l", "--log", type=str,
+                        help="Which file to log to (default: stdout)")
+    parser.add_argument("-q", "--queue", type=str, default="doc",
+                        help="Which beanstalk queue to use (default: doc)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Log level INFO")
+    parser.add_argument("--debug", action="store_true",
+                        help="Log level DEBUG")
+    parser.add_argument("--cache", type=str, default="upload.sqlite",
+                        help=("The upload.py cache database " +
+                              "(default: upload.sqlite)"))
+    parser.add_argument("--since", type=str,
+                        help="Only documents created at or after (ISO date)")
+    parser.add_argument("--until", type=str,
+                        help="Only documents created before (ISO date)")
+    parser.add_argument("--source", type=str, action="append",
+                        help="Only documents from source (repeatable)")
+    parser.add_argument("--digest", type=str, action="append",
+                        help="Only the document with sha256 (repeatable)")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="Maximum jobs per second (default: 1)")
+    parser.add_argument("--max-ready", type=int, default=100,
+                        help=("Wait while the tube a document is routed " +
+                              "to has more ready jobs than this " +
+                              "(default: 100)"))
+    parser.add_argument("--policy", type=str,
+                        help="Priority/TTR/tube policy, as for upload.py")
+    parser.add_argument("--languages", type=str, default="en",
+                        help=("Comma separated languages the NLP can " +
+                              "analyse, as for upload.py (default: en)"))
+    parser.add_argument("--gazetteer-aliases", type=str,
+                        help=("Pre-tag threat actors from this aliases.cfg, " +
+                              "as for upload.py"))
+    parser.add_argument("--gazetteer-tools", type=str,
+                        help="Pre-tag tools from this tools.cfg")
+    parser.add_argument("--gazetteer-sectors", type=str,
+                        help="Pre-tag sectors from this sectors.cfg")
+    foreign = parser.add_mutually_exclusive_group()
+    foreign.add_argument("--foreign-queue", type=str,
+                         help=("Beanstalk queue for documents in other " +
+                               "languages (default: same as --queue)"))
+    foreign.add_argument("--skip-foreign", action="store_true",
+                         help="Do not enqueue documents in other languages")
+    parser.add_argument("--pack", type=str,
+                        help="Pack store used by upload.py, if any")
+    parser.add_argument("--export", type=str, default="./export/",
+                        help=("Where entries from the pack store are " +
+                              "written (default: ./export/)"))
+    parser.add_argument("--checkpoint", type=str,
+                        default="backfill.checkpoint",
+                        help=("File storing progress " +
+                              "(default: backfill.checkpoint)"))
+    parser.add_argument("--reset", action="store_true",
+                        help="Ignore the checkpoint and start from the top")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only log what would be enqueued")
+
+    return parser.parse_args()
+
+
+def select_documents(conn, args, after_id, batch_size=100):
+    """Generate (id, filename, sha256) from the upload table matching the
+    date and digest filters in args, ordered by id, starting after
+    after_id. Rows are read in batches, so the database is not kept
+    locked for upload.py while the backfill runs"""
+
+    sql = "SELECT id, filename, sha256 FROM upload WHERE id > ?"
+    params = []
+
+    if args.since:
+        sql += " AND description >= ? AND description != 'NA'"
+        params.append(args.since)
+    if args.until:
+        sql += " AND description < ? AND description != 'NA'"
+        params.append(args.until)
+    if args.digest:
+        sql += " AND sha256 IN ({0})".format(",".join("?" * len(args.digest)))
+        params.extend(args.digest)
+
+    sql += " ORDER BY id LIMIT ?"
+
+    while True:
+        rows = conn.execute(sql, [after_id] + params + [batch_size]).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        after_id = rows[-1][0]
+
+
+def load_metadata(filename, store):
+    """Return the original meta data for an uploaded document, or None if
+    the document is no longer available"""
+
+    if store and not os.path.isabs(filename):
+        meta = store.get(filename[:-4] + "meta")
+        return json.loads(meta) if meta is not None else None
+
+    if not os.path.isfile(filename):
+        return None
+
+    meta_filename = filename[:-4] + "meta"
+    if filename.endswith(".html") and os.path.isfile(meta_filename):
+        with open(meta_filename, "r") as metadata_file:
+            return json.load(metadata_file)
+
+    LOGGER.warning("No meta data for %s", filename)
+    return {}
+
+
+def document_info(filename, metadata, store):
+    """Return (size, language) of a document, without exporting it from
+    the pack store"""
+
+    if store and not os.path.isabs(filename):
+        data = store.get(filename) or b""
+        language = metadata.get("language") or detect_language(
+            html_to_text(data.decode("utf-8", "replace")))
+        return len(data), language
+
+    return os.path.getsize(filename), document_language(metadata, filename)
+
+
+def document_path(filename, store, export):
+    """Return a path to the document that scio-back can read, exporting
+    it from the pack store if needed"""
+
+    if store and not os.path.isabs(filename):
+        return os.path.abspath(store.export(filename, export))
+
+    return filename
+
+
+def wait_for_capacity(bs_conn, queue, max_ready):
+    """Block while the queue holds more than max_ready ready jobs"""
+
+    while True:
+        try:
+            ready = int(bs_conn.stats_tube(queue)["current-jobs-ready"])
+        except pystalkd.Beanstalkd.CommandFailed:
+            return
+        if ready <= max_ready:
+            return
+        LOGGER.debug("%d ready jobs in %s, waiting", ready, queue)
+        time.sleep(5)
+
+
+def filters(args):
+    """The document selection in args, stored with the checkpoint"""
+
+    return {
+        "since": args.since,
+        "until": args.until,
+        "source": sorted(args.source or []),
+        "digest": sorted(args.digest or []),
+        "languages": args.languages if args.skip_foreign else None,
+    }
+
+
+def main(args):
+    """entry point"""
+
+    checkpoint = Checkpoint(args.checkpoint, filters(args))
+    try:
+        after_id = 0 if args.reset else checkpoint.load()
+    except ValueError as err:
+        LOGGER.error("Not resuming, the filters differ (use --reset to " +
+                     "start over): %s", err)
+        return
+    LOGGER.info("Starting after upload id %d", after_id)
+
+    # choose_queue() routes with args.job_policy, as in upload.py
+    args.job_policy = JobPolicy(args.policy)
+    store = PackStore(args.pack) if args.pack else None
+    conn = sqlite3.connect(args.cache)
+
+    if args.gazetteer_aliases or args.gazetteer_tools or \
+       args.gazetteer_sectors:
+        args.gazetteer = Gazetteer(args.gazetteer_aliases,
+                                   args.gazetteer_tools,
+                                   args.gazetteer_sectors)
+    else:
+        args.gazetteer = None
+
+    bs_conn = pystalkd.Beanstalkd.Connection()
+
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    last_put = 0.0
+    count = 0
+
+    for row_id, filename, sha256 in select_documents(conn, args, after_id):
+        my_metadata = load_metadata(filename, store)
+        if my_metadata is None:
+            LOGGER.warning("%s (%s) no longer available", filename, sha256)
+        elif args.source and my_metadata.get("source") not in args.source:
+            LOGGER.debug("Skipping %s, source not selected", filename)
+        else:
+            size, my_metadata['language'] = document_info(
+                filename, my_metadata, store)
+            my_metadata['filename'] = filename
+            queue = choose_queue(args, my_metadata, size)
+
+            if not queue:
+                LOGGER.info("Not enqueuing %s (language %s)",
+                            filename, my_metadata['language'])
+            elif args.dry_run:
+                LOGGER.info("Would enqueue %s on %s", filename, queue)
+                count += 1
+            else:
+                # live ingest of the same size class shares the tube
+                wait_for_capacity(bs_conn, queue, args.max_ready)
+                time.sleep(max(0.0, last_put + interval - time.monotonic()))
+                last_put = time.monotonic()
+
+                # only export from the pack store what is enqueued
+                path = document_path(filename, store, args.export)
+                my_metadata['filename'] = path
+                if args.gazetteer and path.endswith(".html"):
+                    my_metadata['pretag'] = pretag(args.gazetteer, path)
+                LOGGER.debug("Enqueue %s on %s", path, queue)
+                bs_conn.use(queue)
+                bs_conn.put(json.dumps(my_metadata),
+                            priority=args.job_policy.priority(my_metadata),
+                            ttr=args.job_policy.ttr(size))
+                count += 1
+
+        if not args.dry_run:
+            checkpoint.save(row_id)
+
+    LOGGER.info("Enqueued %d documents", count)
+
+
+if __name__ == "__main__":
+    ARGS = init()
+    FORMAT = '%(asctime)-15s [%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s' # NOQA
+
+    LOGCFG = {
+        "format": FORMAT,
+        "level": logging.WARN,
+    }
+
+    if ARGS.verbose:
+        LOGCFG['level'] = logging.INFO
+
+    if ARGS.debug:
+        LOGCFG['level'] = logging.DEBUG
+
+    if ARGS.log:
+        LOGCFG['filename'] = ARGS.log
+
+    logging.basicConfig(**LOGCFG)
+
+    try:
+        main(ARGS)
+    except IOError as err:
+        LOGGER.error(err)
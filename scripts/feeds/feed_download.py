@@ -24,22 +24,33 @@ from datetime import datetime
 
 import argparse
 import concurrent.futures
+import hashlib
 import html
 import json
 import logging
 import os.path
-import shutil
+import socket
 import sys
+import threading
 import time
 import urllib.parse
 import urllib.request
 import urllib3
 
 import justext
-import requests
 import feedparser
 from bs4 import BeautifulSoup
 
+import feedqueue
+from fetch import CircuitOpenError, Deadline, DeadlineExceeded, Fetcher
+from fetch import SingleFlight, normalize_url, read_chunks
+from warc import WarcArchive, WarcWriter
+from gazetteer import html_to_text
+from language import detect_language
+from manifest import Manifest
+from packstore import PackStore
+from profiling import Profiler, profile_directory
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 LOGGER = logging.getLogger('root')
@@ -70,12 +81,66 @@ def init():
                         help="Log level DEBUG")
     parser.add_argument("--debug", action="store_true",
                         help="Log level DEBUG")
+    parser.add_argument("--profile", action="store_true",
+                        help=("Write cProfile and tracemalloc statistics " +
+                              "next to the log file"))
     parser.add_argument("--output", type=str, default="./download/",
                         help="Storage .html files (default: ./download/)")
     parser.add_argument("--meta", type=str, default="./download/",
                         help="Storage meta data files (default: ./download/)")
     parser.add_argument("--feeds", default="./feeds.txt", type=str,
                         help="feed urls (one pr. line) (default: ./feeds.txt)")
+    parser.add_argument("--connect-timeout", type=float, default=10,
+                        help="Connect timeout in seconds (default: 10)")
+    parser.add_argument("--read-timeout", type=float, default=30,
+                        help="Read timeout in seconds (default: 30)")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="Retries on connection errors and 5xx (default: 2)")
+    parser.add_argument("--backoff", type=float, default=1.0,
+                        help="Initial retry backoff in seconds (default: 1)")
+    parser.add_argument("--breaker-threshold", type=int, default=5,
+                        help=("Consecutive failures before a host is " +
+                              "skipped (default: 5)"))
+    parser.add_argument("--breaker-cooldown", type=float, default=300,
+                        help=("Seconds a failing host is skipped " +
+                              "(default: 300)"))
+    parser.add_argument("--cache-size", type=int, default=256,
+                        help=("Number of responses and downloads kept to " +
+                              "avoid fetching the same url twice in a run " +
+                              "(default: 256)"))
+    parser.add_argument("--feed-budget", type=float, default=600,
+                        help=("Total seconds allowed per feed, 0 for no " +
+                              "limit (default: 600)"))
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--coordinator", action="store_true",
+                      help=("Enqueue the feeds in --feed-tube for " +
+                            "downloader workers instead of downloading"))
+    mode.add_argument("--worker", action="store_true",
+                      help="Download feeds enqueued in --feed-tube")
+    parser.add_argument("--beanstalk", type=str, default="localhost:11300",
+                        help="beanstalkd host:port (default: localhost:11300)")
+    parser.add_argument("--feed-tube", type=str, default="feeds",
+                        help="Tube for feed jobs (default: feeds)")
+    parser.add_argument("--force-cycle", action="store_true",
+                        help=("Enqueue a new cycle even if jobs from the " +
+                              "previous cycle are still in --feed-tube"))
+    parser.add_argument("--workers", type=int, default=10,
+                        help="Worker threads in --worker mode (default: 10)")
+    warc = parser.add_mutually_exclusive_group()
+    warc.add_argument("--warc-record", type=str, metavar="DIR",
+                      help="Record all HTTP responses to .warc.gz files in DIR")
+    warc.add_argument("--warc-replay", type=str, metavar="DIR",
+                      help=("Replay HTTP responses from the .warc.gz files " +
+                            "in DIR instead of using the network"))
+    parser.add_argument("--pack", type=str,
+                        help=("Store .html and .meta in compressed pack " +
+                              "files in this directory instead of " +
+                              "--output/--meta (with --worker: " +
+                              "DIR.HOSTNAME)"))
+    parser.add_argument("--manifest", type=str,
+                        help=("Append every completed entry to this " +
+                              "manifest journal, read by upload.py " +
+                              "(with --worker: MANIFEST.HOSTNAME)"))
 
     return parser.parse_args()
 
@@ -120,7 +185,7 @@ def safe_filename(path):
                    c in "_ -.").replace(" ", "_")
 
 
-def download_and_store(feed_url, path, link):
+def download_and_store(args, feed_url, path, link, deadline=None):
     """Download and store a link. Storage defined in args"""
 
     if not os.path.isdir(path):
@@ -133,17 +198,6 @@ def download_and_store(feed_url, path, link):
          link = link.replace('github.com', 'raw.githubusercontent.com').replace('/blob/', '/')
          LOGGER.info("modified link: {0}".format(link))
 
-    headers = requests.utils.default_headers()
-
-    # Update the headers with your custom ones
-    # You don't have to worry about case-sensitivity with
-    # the dictionary keys, because default_headers uses a custom
-    # CaseInsensitiveDict implementation within requests' source code.
-    headers.update(
-        {
-            'User-Agent': 'Mozilla/5.0 Gecko/56.0 Firefox/56.0',
-        })
-
     parsed = urllib.parse.urlparse(link)
 
     if parsed.netloc == '':
@@ -153,89 +207,127 @@ def download_and_store(feed_url, path, link):
         LOGGER.info("possible relative path %s, trying to append host: %s",
                     parsed.path, parsed_feed_url.netloc)
 
-    req = requests.get(link,
-                       headers=headers,
-                       verify=False,
-                       stream=True,
-                       timeout=60)
+    # the same document is often linked from several entries and feeds,
+    # only download it once per run
+    return args.downloads.do(
+        (path, normalize_url(link)),
+        lambda: fetch_and_store(args, path, link, deadline),
+        deadline)
+
+
+def fetch_and_store(args, path, link, deadline=None):
+    """Fetch link and write it to a file in path. Returns the file name,
+    or None if nothing was written"""
+
+    req = args.fetcher.get(link, deadline=deadline, stream=True)
 
     if req.status_code >= 400:
         LOGGER.info("Status %s - %s", req.status_code, link)
-        return
+        req.close()
+        return None
 
     url = urllib.parse.urlparse(link)
     fname = os.path.join(path, safe_filename(os.path.basename(url.path)))
     with open("/opt/scio_feeds/ignore.txt") as f:
         ignored = [l.strip() for l in f.readlines()]
         if fname in ignored:
-            return
-    with open(fname, "wb") as download_file:
-        LOGGER.info("Writing %s", fname)
-        req.raw.decode_content = True
-        shutil.copyfileobj(req.raw, download_file)
+            return None
+    try:
+        with open(fname, "wb") as download_file:
+            LOGGER.info("Writing %s", fname)
+            for chunk in read_chunks(req, deadline, link):
+                download_file.write(chunk)
+    except Exception:
+        # do not leave a truncated file behind for submitcache.py, from a
+        # slow host or a broken connection
+        req.close()
+        os.remove(fname)
+        raise
+
+    return fname
 
 
-def check_links(feed_url, args, links):
+def check_links(feed_url, args, links, deadline=None):
     """Run though a list of urls, checking if they contains certain
     elements that looks like possible file download possibilities"""
 
     for link in links:
+        if deadline and deadline.expired():
+            LOGGER.warning("Feed budget exceeded, skipping links from %s",
+                           feed_url)
+            return
         try:
             link_lower = link.lower()
             if args.download_pdf and ".pdf" in link_lower:
-                download_and_store(feed_url, args.pdf_store, link)
+                download_and_store(args, feed_url, args.pdf_store, link,
+                                   deadline)
             if args.download_doc and ".doc" in link_lower:
-                download_and_store(feed_url, args.doc_store, link)
+                download_and_store(args, feed_url, args.doc_store, link,
+                                   deadline)
             if args.download_xls and ".xls" in link_lower:
-                download_and_store(feed_url, args.xls_store, link)
+                download_and_store(args, feed_url, args.xls_store, link,
+                                   deadline)
             if args.download_xml and ".xml" in link_lower:
-                download_and_store(feed_url, args.xml_store, link)
+                download_and_store(args, feed_url, args.xml_store, link,
+                                   deadline)
             if args.download_csv and ".csv" in link_lower:
-                download_and_store(feed_url, args.csv_store, link)
+                download_and_store(args, feed_url, args.csv_store, link,
+                                   deadline)
+        except CircuitOpenError as exc:
+            LOGGER.info("%s", exc)
         except Exception as exc:  # pylint: disable=W0703
             LOGGER.error('%r generated an exception: %s', link, exc)
             exc_info = (type(exc), exc, exc.__traceback__)
             LOGGER.error('Exception occurred', exc_info=exc_info)
 
 
-def get_feed(feed_url):
+def get_feed(args, feed_url, deadline=None):
     """Download and parse a feed"""
 
     feed_url = feed_url.strip()
 
     LOGGER.info("Opening feed : %s", feed_url)
 
-    headers = requests.utils.default_headers()
-    headers.update(
-        {
-            'User-Agent': 'Mozilla/5.0 Gecko/56.0 Firefox/56.0',
-        })
-
-    req = requests.get(feed_url, headers=headers, verify=False, timeout=60)
+    req = args.fetcher.get(feed_url, deadline=deadline)
 
     return feedparser.parse(req.text)
 
 
-def partial_entry_text_to_file(args, entry):
-    """Download the original content and write it to the proper file.
-    Return the html."""
+def write_html(args, filename, html_data):
+    """Write the html for an entry, either to the pack store or to
+    a .html file in the output directory. Returns False if the entry
+    was already stored with the same html"""
 
-    headers = requests.utils.default_headers()
-    headers.update(
-        {
-            'User-Agent': 'Mozilla/5.0 Gecko/56.0 Firefox/56.0',
-        })
+    if args.pack_store:
+        return args.pack_store.put(filename + ".html", html_data)
+
+    full_filename = os.path.join(args.output, filename + ".html")
+    if os.path.isfile(full_filename):
+        with open(full_filename, "r") as html_file:
+            if html_file.read() == html_data:
+                return False
+
+    with open(full_filename, "w") as html_file:
+        html_file.write(html_data)
+
+    return True
+
+
+def partial_entry_text_to_file(args, entry, deadline=None):
+    """Download the original content and write it to the proper file.
+    Return the file name, the html and whether the entry is new or
+    changed."""
 
     if "link" not in entry:
         LOGGER.warning("entry does not contain 'link'")
-        return None, None
+        return None, None, False
 
     url = entry["link"]
 
-    req = requests.get(url, headers=headers, verify=False, timeout=60)
+    req = args.fetcher.get(url, deadline=deadline)
 
     if req.status_code >= 400:
-        return None, None
+        return None, None, False
 
     filename = safe_filename(entry['title'])
 
@@ -255,28 +347,25 @@ def partial_entry_text_to_file(args, entry):
 
     html_data += "\n</body>\n</html_data>"
 
-    full_filename = os.path.join(args.output, filename + ".html")
-    with open(full_filename, "w") as html_file:
-        html_file.write(html_data)
+    changed = write_html(args, filename, html_data)
 
     # we want to return the raw_html and not the "article extraction"
     # since we want to extract links to .pdfs etc.
-    return filename, raw_html
+    return filename, raw_html, changed
 
 
 def entry_text_to_file(args, entry):
     """Extract the entry content and write it to the proper file.
-    Return the wrapped HTML"""
+    Return the file name, the wrapped HTML and whether the entry is new
+    or changed"""
 
     filename = safe_filename(entry['title'])
 
     html_data = create_html(entry)
 
-    full_filename = os.path.join(args.output, filename + ".html")
-    with open(full_filename, "w") as html_file:
-        html_file.write(html_data)
+    changed = write_html(args, filename, html_data)
 
-    return filename, html_data
+    return filename, html_data, changed
 
 
 def html_information_extraction(entry, html_data):
@@ -284,17 +373,20 @@ def html_information_extraction(entry, html_data):
     do something to."""
 
     links = []
+    language = "und"
     soup = BeautifulSoup(html_data, "html.parser")
     if soup:
         links = [a['href'] for a in soup.findAll('a', href=True)]
+        # the same text upload.py detects on, without script and style
+        language = detect_language(html_to_text(html_data))
     else:
         LOGGER.warning("soup is none : %s", entry['title'])
 
-    return {"links": links}
+    return {"links": links, "language": language}
 
 
 def create_entry_meta_file(args, filename, feed_title, entry, my_info):
-    """Create the meta file for a single entry"""
+    """Create the meta file for a single entry. Returns the meta data"""
 
     if feed_title.strip() == "":
         parsed_uri = urllib.parse.urlparse(entry['link'])
@@ -308,16 +400,54 @@ def create_entry_meta_file(args, filename, feed_title, entry, my_info):
     else:
         creation_date = datetime.fromtimestamp(time.mktime(published))
 
+    data = {
+        "link": entry["link"],
+        "source": feed_title,
+        "creation-date": creation_date.isoformat(),
+        "title": entry["title"],
+        }
+    data.update(my_info)
+
+    if args.pack_store:
+        args.pack_store.put(filename + ".meta", json.dumps(data))
+        return data
+
     with open(os.path.join(args.meta, filename + ".meta"), "w") as meta_file:
-        data = {
-            "link": entry["link"],
-            "source": feed_title,
-            "creation-date": creation_date.isoformat(),
-            "title": entry["title"],
-            }
-        data.update(my_info)
         json.dump(data, fp=meta_file, indent=4)
 
+    return data
+
+
+def append_manifest(args, filename, html_data, data):
+    """Record a new or changed entry in the manifest journal, if enabled.
+    The digest is the one upload.py uses for its cache; the link for
+    partial feeds and the html content for full feeds"""
+
+    if not args.manifest_journal:
+        return
+
+    if data["partial_feed"]:
+        digest = hashlib.sha256(data["link"].encode("utf-8")).hexdigest()
+    else:
+        digest = hashlib.sha256(html_data.encode("utf-8")).hexdigest()
+
+    if args.pack_store:
+        html_path = filename + ".html"
+        meta_path = filename + ".meta"
+    else:
+        html_path = os.path.abspath(os.path.join(args.output,
+                                                 filename + ".html"))
+        meta_path = os.path.abspath(os.path.join(args.meta,
+                                                 filename + ".meta"))
+
+    args.manifest_journal.append({
+        "html": html_path,
+        "meta": meta_path,
+        "pack": bool(args.pack_store),
+        "sha256": digest,
+        "metadata": data,
+        })
+
 
 def handle_partial_feed(args, feed_url):
     """Take a feed, extract all entries, download the full original
@@ -325,7 +455,9 @@ def handle_partial_feed(args, feed_url):
     if specified in the arguments and write the feed entry content
     to disk together with a meta data json file"""
 
-    feed = get_feed(feed_url)
+    deadline = Deadline(args.feed_budget)
+
+    feed = get_feed(args, feed_url, deadline)
 
     if not feed:
         return "NOT FEED", feed_url
@@ -335,15 +467,28 @@ def handle_partial_feed(args, feed_url):
                 len(feed["entries"]))
 
     for entry_n, entry in enumerate(feed["entries"]):
+        if deadline.expired():
+            return "BUDGET EXCEEDED", feed_url
+
         LOGGER.info("Handling : %s of %s : %s",
                     entry_n, len(feed["entries"]), entry['title'])
 
-        filename, raw_html = partial_entry_text_to_file(args, entry)
+        try:
+            filename, raw_html, changed = partial_entry_text_to_file(
+                args, entry, deadline)
+        except CircuitOpenError as exc:
+            LOGGER.info("%s", exc)
+            continue
+        except DeadlineExceeded:
+            return "BUDGET EXCEEDED", feed_url
+
         my_info = html_information_extraction(entry, raw_html)
         my_info["partial_feed"] = True
-        create_entry_meta_file(args, filename,
-                               feed["feed"]["title"], entry, my_info)
-        check_links(entry["link"], args, my_info["links"])
+        data = create_entry_meta_file(args, filename,
+                                      feed["feed"]["title"], entry, my_info)
+        if changed:
+            append_manifest(args, filename, raw_html, data)
+        check_links(entry["link"], args, my_info["links"], deadline)
 
     return "OK", feed_url
 
@@ -354,7 +499,9 @@ def handle_feed(args, feed_url):
     if specified in the arguments and write the feed entry content
     to disk together with a meta data json file"""
 
-    feed = get_feed(feed_url)
+    deadline = Deadline(args.feed_budget)
+
+    feed = get_feed(args, feed_url, deadline)
 
     if not feed:
         return "NOT FEED", feed_url
@@ -364,35 +511,52 @@ def handle_feed(args, feed_url):
                 len(feed["entries"]))
 
     for entry_n, entry in enumerate(feed["entries"]):
+        if deadline.expired():
+            return "BUDGET EXCEEDED", feed_url
+
         LOGGER.info("Handling : %s of %s : %s",
                     entry_n, len(feed["entries"]), entry['title'])
 
-        filename, html_data = entry_text_to_file(args, entry)
+        filename, html_data, changed = entry_text_to_file(args, entry)
         my_info = html_information_extraction(entry, html_data)
         my_info["partial_feed"] = False
-        create_entry_meta_file(args, filename,
-                               feed["feed"]["title"], entry, my_info)
-        check_links(entry["link"], args, my_info["links"])
+        data = create_entry_meta_file(args, filename,
+                                      feed["feed"]["title"], entry, my_info)
+        if changed:
+            append_manifest(args, filename, html_data, data)
+        check_links(entry["link"], args, my_info["links"], deadline)
 
     return "OK", feed_url
 
 
 def parse_feed_file(filename):
     """Parse feed file, split feeds into partial and full feeds
-    (lines starting with 'f ' and 'p ')"""
+    (lines starting with 'f ' and 'p '). Urls are normalized and
+    duplicates removed"""
 
     full_feeds = []
     partial_feeds = []
+    seen = set()
 
     for linenum, feed_line in enumerate(open(filename)):
         if len(feed_line) < 2:
             sys.stderr.write("line {0} to short".format(linenum+1))
+            continue
         elif feed_line[:2] == "f ":
-            full_feeds.append(feed_line[2:].strip())
+            feeds = full_feeds
         elif feed_line[:2] == "p ":
-            partial_feeds.append(feed_line[2:].strip())
+            feeds = partial_feeds
         else:
             sys.stderr.write("line ({0}), '{1}' is not a valid type [fp]\n".format(linenum+1, feed_line[0])) # NOQA
+            continue
+
+        feed_url = normalize_url(feed_line[2:])
+        if feed_url in seen:
+            LOGGER.warning("line %s, duplicate feed %s", linenum+1, feed_url)
+            continue
+
+        seen.add(feed_url)
+        feeds.append(feed_url)
 
     return full_feeds, partial_feeds
 
@@ -402,7 +566,8 @@ def download_feed_list(args, feed_list, handler_fn):
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
         # Start the load operations and mark each future with its URL
-        future_to_url = {executor.submit(handler_fn, args, url): url
+        profiled_fn = args.profiler.wrap(handler_fn.__name__, handler_fn)
+        future_to_url = {executor.submit(profiled_fn, args, url): url
                          for url in feed_list}
         for future in concurrent.futures.as_completed(future_to_url):
             url = future_to_url[future]
@@ -418,13 +583,91 @@ def download_feed_list(args, feed_list, handler_fn):
                             result)
 
 
+def download_feed_queue(args):
+    """Handle feed jobs from the feed tube with a number of worker
+    threads, each with its own beanstalk connection, until the tube
+    is drained"""
+
+    handlers = {
+        feedqueue.FULL_FEED: args.profiler.wrap("handle_feed", handle_feed),
+        feedqueue.PARTIAL_FEED: args.profiler.wrap("handle_partial_feed",
+                                                   handle_partial_feed),
+    }
+
+    def worker():
+        """Worker thread main loop"""
+
+        conn = feedqueue.connect(args.beanstalk)
+        try:
+            feedqueue.work(args, conn, args.feed_tube, handlers)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def node_path(path):
+    """path with the host name of this node appended. The pack store and
+    manifest are not safe to share between processes or over a network
+    file system, so every worker node gets its own"""
+
+    return "{0}.{1}".format(path.rstrip(os.sep), socket.gethostname())
+
+
 def main(args):
     """Main program loop. entry point"""
 
-    full_feeds, partial_feeds = parse_feed_file(args.feeds)
+    if args.worker:
+        if args.pack:
+            args.pack = node_path(args.pack)
+            LOGGER.info("Using pack store %s", args.pack)
+        if args.manifest:
+            args.manifest = node_path(args.manifest)
+            LOGGER.info("Using manifest %s", args.manifest)
+
+    args.fetcher = Fetcher(connect_timeout=args.connect_timeout,
+                           read_timeout=args.read_timeout,
+                           retries=args.retries,
+                           backoff=args.backoff,
+                           breaker_threshold=args.breaker_threshold,
+                           breaker_cooldown=args.breaker_cooldown,
+                           cache_size=args.cache_size,
+                           recorder=(WarcWriter(args.warc_record)
+                                     if args.warc_record else None),
+                           archive=(WarcArchive(args.warc_replay,
+                                                normalize_url)
+                                    if args.warc_replay else None))
+    args.downloads = SingleFlight(args.cache_size)
+    args.pack_store = PackStore(args.pack) if args.pack else None
+    args.manifest_journal = Manifest(args.manifest) if args.manifest else None
+    args.profiler = Profiler("feed_download", profile_directory(args.log),
+                             args.profile)
+
+    try:
+        if args.worker:
+            # workers get the feeds from the tube, not from --feeds
+            download_feed_queue(args)
+            return
 
-    download_feed_list(args, full_feeds, handle_feed)
-    download_feed_list(args, partial_feeds, handle_partial_feed)
+        with args.profiler.stage("parse_feed_file"):
+            full_feeds, partial_feeds = parse_feed_file(args.feeds)
+
+        if args.coordinator:
+            # The TTR must cover the whole feed budget, or beanstalkd
+            # hands the feed to another worker while it is still running
+            feedqueue.enqueue_feeds(feedqueue.connect(args.beanstalk),
+                                    args.feed_tube, full_feeds, partial_feeds,
+                                    ttr=int(args.feed_budget or 3600) + 120,
+                                    force=args.force_cycle)
+        else:
+            download_feed_list(args, full_feeds, handle_feed)
+            download_feed_list(args, partial_feeds, handle_partial_feed)
+    finally:
+        args.profiler.dump()
 
 
 if __name__ == "__main__":
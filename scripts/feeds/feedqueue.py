@@ -0,0 +1,126 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Distributed feed fetching through a beanstalk tube.
+
+A coordinator enqueues one job per feed for each cycle. Any number of
+downloader workers, on any number of nodes, reserve jobs, handle the feed
+and delete the job. If a worker dies, beanstalkd hands the job to another
+worker when the TTR runs out. A new cycle is not started while jobs from
+the previous cycle are still in the tube, so each feed is handled by one
+worker per cycle.
+"""
+
+from datetime import datetime
+
+import json
+import logging
+
+import pystalkd.Beanstalkd
+
+LOGGER = logging.getLogger('root')
+
+FULL_FEED = "f"
+PARTIAL_FEED = "p"
+
+
+def connect(address):
+    """Connect to beanstalkd at host:port"""
+
+    host, _, port = address.partition(":")
+
+    return pystalkd.Beanstalkd.Connection(host=host or "localhost",
+                                          port=int(port or 11300))
+
+
+def pending_jobs(conn, tube):
+    """Number of ready, reserved and delayed jobs in tube"""
+
+    try:
+        stats = conn.stats_tube(tube)
+    except pystalkd.Beanstalkd.CommandFailed:
+        # the tube does not exist until something is put into it
+        return 0
+
+    return (int(stats["current-jobs-ready"]) +
+            int(stats["current-jobs-reserved"]) +
+            int(stats["current-jobs-delayed"]))
+
+
+# pylint: disable=too-many-arguments
+def enqueue_feeds(conn, tube, full_feeds, partial_feeds, ttr, force=False):
+    """Put one job per feed in tube, unless the previous cycle is still
+    running. Returns the number of jobs enqueued"""
+
+    pending = pending_jobs(conn, tube)
+    if pending and not force:
+        LOGGER.warning("%d jobs from the previous cycle still in %s, " +
+                       "not starting a new cycle", pending, tube)
+        return 0
+
+    cycle = datetime.now().isoformat()
+
+    conn.use(tube)
+
+    count = 0
+    for feed_type, feeds in ((FULL_FEED, full_feeds),
+                             (PARTIAL_FEED, partial_feeds)):
+        for feed_url in feeds:
+            conn.put(json.dumps({"type": feed_type,
+                                 "url": feed_url,
+                                 "cycle": cycle}), ttr=ttr)
+            count += 1
+
+    LOGGER.info("Enqueued %d feeds in %s for cycle %s", count, tube, cycle)
+    return count
+
+
+# pylint: disable=too-many-arguments
+def work(args, conn, tube, handlers, reserve_timeout=30, max_releases=3):
+    """Reserve and handle feed jobs from tube until no job is available
+    for reserve_timeout seconds. handlers maps the feed type to the
+    handler function (handle_feed/handle_partial_feed). Failing jobs are
+    released with a delay and buried after max_releases attempts"""
+
+    conn.watch(tube)
+    conn.ignore("default")
+
+    while True:
+        job = conn.reserve(timeout=reserve_timeout)
+        if job is None:
+            LOGGER.info("No more jobs in %s", tube)
+            return
+
+        try:
+            feed_job = json.loads(job.body)
+            handler_fn = handlers[feed_job["type"]]
+            result, feed = handler_fn(args, feed_job["url"])
+        except Exception as exc:  # pylint: disable=W0703
+            LOGGER.error('%r generated an exception: %s', job.body, exc)
+            exc_info = (type(exc), exc, exc.__traceback__)
+            LOGGER.error('Exception occurred', exc_info=exc_info)
+
+            releases = int(job.stats().get("releases", 0))
+            if releases >= max_releases:
+                LOGGER.error("Burying %s after %d attempts",
+                             job.body, releases + 1)
+                job.bury()
+            else:
+                job.release(delay=60 * (releases + 1))
+        else:
+            LOGGER.info("%s returned %s", feed, result)
+            job.delete()
@@ -0,0 +1,439 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+HTTP fetching with per-host health tracking for the feed downloader.
+
+Every request gets separate connect and read timeouts, bounded retries
+with exponential backoff and an optional deadline. Hosts failing
+repeatedly are skipped (circuit open) for a cooldown period, so a dead or
+tar-pitting host can not hold a worker thread for long. Bodies are always
+streamed in small reads, and the deadline is checked between reads.
+
+Concurrent and repeated requests for the same (normalized) URL within a
+run are coalesced into a single request, and the response is shared
+through a bounded LRU cache.
+"""
+
+import collections
+import logging
+import threading
+import time
+import urllib.parse
+
+import requests
+import urllib3
+
+LOGGER = logging.getLogger('root')
+
+USER_AGENT = 'Mozilla/5.0 Gecko/56.0 Firefox/56.0'
+
+TRACKING_PARAMETERS = ("utm_", "fbclid", "gclid")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+READ_CHUNK_SIZE = 16 * 1024
+
+
+def normalize_url(url):
+    """Normalize url so equivalent urls compare equal: lower case scheme
+    and host, no default port, no fragment and no tracking parameters"""
+
+    parsed = urllib.parse.urlsplit(url.strip())
+
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or "").lower()
+    if parsed.port and parsed.port != DEFAULT_PORTS.get(scheme):
+        netloc = "{0}:{1}".format(netloc, parsed.port)
+    if parsed.username:
+        netloc = "{0}@{1}".format(parsed.netloc.rsplit("@", 1)[0], netloc)
+
+    query = parsed.query
+    params = urllib.parse.parse_qsl(query, keep_blank_values=True)
+    kept = [(key, value) for key, value in params
+            if not key.lower().startswith(TRACKING_PARAMETERS)]
+    if len(kept) != len(params):
+        query = urllib.parse.urlencode(kept)
+
+    return urllib.parse.urlunsplit((scheme, netloc, parsed.path or "/",
+                                    query, ""))
+
+
+class SingleFlight(object):
+    """SingleFlight runs a function once per key. Callers asking for a
+    key that is already being computed wait for and share that result.
+    Successful results are kept in a LRU cache of maxsize entries.
+    Exceptions are passed to every waiting caller, but not cached. A
+    caller whose leader ran out of its own deadline retries as the new
+    leader instead"""
+
+    class Call(object):
+        """An in-flight computation"""
+
+        def __init__(self):
+
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, maxsize=256):
+
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.calls = {}
+
+    def do(self, key, function, deadline=None):
+        """Return function(), computed at most once for concurrent or
+        cached calls with the same key. Waits for an in-flight call at
+        most until deadline, then raises DeadlineExceeded"""
+
+        while True:
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    LOGGER.debug("Reusing result for %s", key)
+                    return self.cache[key]
+
+                call = self.calls.get(key)
+                if call is None:
+                    call = self.calls[key] = SingleFlight.Call()
+                    break
+
+            LOGGER.debug("Waiting for in-flight %s", key)
+            if not call.done.wait(deadline.remaining() if deadline else None):
+                raise DeadlineExceeded("No time left waiting for {0}"
+                                       .format(key))
+            if isinstance(call.error, DeadlineExceeded):
+                # the leader ran out of its budget, not necessarily ours
+                continue
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as err:
+            call.error = err
+            raise
+        else:
+            with self.lock:
+                self.cache[key] = call.result
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is made to a host with an open circuit"""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the time budget for a request is used up"""
+
+
+class Deadline(object):
+    """Deadline is a point in time after which no more work should be
+    started. A budget of None never expires"""
+
+    def __init__(self, budget=None):
+
+        self.expires = time.monotonic() + budget if budget else None
+
+    def remaining(self):
+        """Seconds left, or None if the deadline never expires"""
+
+        if self.expires is None:
+            return None
+
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        """True if the deadline has passed"""
+
+        return self.expires is not None and time.monotonic() >= self.expires
+
+
+def read_chunks(response, deadline=None, url=None,
+                chunk_size=READ_CHUNK_SIZE):
+    """Generate the body of a streamed response in chunks of at most
+    chunk_size bytes. Each read returns what has arrived so far instead of
+    waiting for a full chunk, so a host trickling data can not run past
+    the deadline by more than one read timeout. This needs read1() from
+    urllib3 >= 2, see Fetcher. Raises DeadlineExceeded and closes the
+    response when deadline runs out"""
+
+    # pylint: disable=protected-access
+    if response._content_consumed:
+        # already read, e.g. replayed from a WARC archive
+        if response.content:
+            yield response.content
+        return
+
+    raw = response.raw
+    read = raw.read1
+
+    while True:
+        if deadline and deadline.expired():
+            response.close()
+            raise DeadlineExceeded("No time left to read {0}"
+                                   .format(url or response.url))
+        try:
+            chunk = read(chunk_size, decode_content=True)
+        except urllib3.exceptions.ProtocolError as err:
+            raise requests.exceptions.ChunkedEncodingError(err)
+        except urllib3.exceptions.DecodeError as err:
+            raise requests.exceptions.ContentDecodingError(err)
+        except urllib3.exceptions.ReadTimeoutError as err:
+            raise requests.exceptions.ConnectionError(err)
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_body(response, deadline=None, url=None):
+    """Read the whole body of a streamed response within deadline, so it
+    behaves like a non-streamed response. See read_chunks()"""
+
+    # pylint: disable=protected-access
+    if response._content_consumed:
+        return response
+
+    response._content = b"".join(read_chunks(response, deadline, url))
+    response._content_consumed = True
+    response.close()
+
+    return response
+
+
+class HostHealth(object):
+    """Circuit breaker for a single host. After threshold consecutive
+    failures the circuit opens and requests are refused until cooldown
+    seconds have passed. A single request is then let through as a trial,
+    others are refused until it ends; success closes the circuit, failure
+    opens it again"""
+
+    def __init__(self, threshold, cooldown):
+
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    def allow(self):
+        """True if a request to the host may be made. Must be followed by
+        success(), failure() or release()"""
+
+        if self.opened is None:
+            return True
+
+        if self.trial or time.monotonic() - self.opened < self.cooldown:
+            return False
+
+        self.trial = True
+        return True
+
+    def success(self):
+        """Record a successful request"""
+
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    def failure(self):
+        """Record a failed request"""
+
+        self.failures += 1
+        self.trial = False
+        if self.failures >= self.threshold:
+            self.opened = time.monotonic()
+
+    def release(self):
+        """Record a request that ended without saying anything about the
+        health of the host"""
+
+        self.trial = False
+
+
+class Fetcher(object):
+    """Fetcher wraps requests.get with timeouts, retries, backoff and
+    per-host circuit breakers. Safe to share between threads."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, connect_timeout=10, read_timeout=30, retries=2,
+                 backoff=1.0, breaker_threshold=5, breaker_cooldown=300,
+                 cache_size=256, recorder=None, archive=None):
+        """recorder (a warc.WarcWriter) records every response. With an
+        archive (a warc.WarcArchive) responses are replayed from it and
+        the network is never used"""
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+
+        if not archive and \
+           not hasattr(urllib3.HTTPResponse, "read1"):
+            # read() waits for a full chunk, so a host trickling data
+            # could hold a worker far past its deadline
+            raise RuntimeError("urllib3 >= 2 is required, found {0}"
+                               .format(urllib3.__version__))
+
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.responses = SingleFlight(cache_size)
+        self.recorder = recorder
+        self.archive = archive
+
+    def health(self, url):
+        """Return the HostHealth for the host of url"""
+
+        host = urllib.parse.urlparse(url).netloc.lower()
+
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostHealth(self.breaker_threshold,
+                                              self.breaker_cooldown)
+            return self.hosts[host]
+
+    def timeout(self, deadline):
+        """Return a (connect, read) timeout tuple bounded by deadline.
+        Raises DeadlineExceeded if no time is left"""
+
+        remaining = deadline.remaining() if deadline else None
+        if remaining is None:
+            return (self.connect_timeout, self.read_timeout)
+
+        if remaining <= 0:
+            # urllib3 refuses a timeout of 0
+            raise DeadlineExceeded("No time left for a request")
+
+        return (min(self.connect_timeout, remaining),
+                min(self.read_timeout, remaining))
+
+    def get(self, url, deadline=None, **kwargs):
+        """GET url. Server errors (>= 500) and connection problems are
+        retried with backoff. Raises CircuitOpenError if the host is
+        being skipped and DeadlineExceeded if deadline runs out.
+
+        Unless streaming, requests for the same normalized url are
+        coalesced and the response object is shared between callers"""
+
+        if kwargs.get("stream"):
+            return self.fetch(url, deadline, **kwargs)
+
+        return self.responses.do(
+            normalize_url(url),
+            lambda: self.fetch(url, deadline, **kwargs),
+            deadline)
+
+    def fetch(self, url, deadline=None, **kwargs):
+        """GET url from the archive or the network, see get()"""
+
+        if self.archive:
+            return self.archive.get(url)
+
+        req = self.request(url, deadline, **kwargs)
+
+        if self.recorder:
+            # the whole body is needed for the record
+            read_body(req, deadline, url)
+            self.recorder.write_response(url, req)
+
+        return req
+
+    def request(self, url, deadline=None, **kwargs):
+        """GET url from the network with retries, see get(). The response
+        is always streamed, and unless the caller asked for a stream the
+        body is read here within deadline"""
+
+        health = self.health(url)
+        stream = kwargs.pop("stream", False)
+
+        headers = requests.utils.default_headers()
+        headers.update({'User-Agent': USER_AGENT})
+
+        attempt = 0
+        while True:
+            if deadline and deadline.expired():
+                raise DeadlineExceeded("No time left to fetch {0}"
+                                       .format(url))
+            # before allow(), so running out of time is not held against
+            # the host
+            timeout = self.timeout(deadline)
+            with self.lock:
+                allowed = health.allow()
+            if not allowed:
+                raise CircuitOpenError("Skipping {0}, host is failing"
+                                       .format(url))
+
+            try:
+                req = requests.get(url, headers=headers, verify=False,
+                                   timeout=timeout,
+                                   stream=True, **kwargs)
+                if req.status_code < 500 and not stream:
+                    read_body(req, deadline, url)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as err:
+                req = None
+                error = err
+            except DeadlineExceeded:
+                # a host too slow to answer within the budget
+                with self.lock:
+                    health.failure()
+                raise
+            except Exception:
+                with self.lock:
+                    health.release()
+                raise
+            else:
+                error = None
+
+            if req is not None and req.status_code < 500:
+                with self.lock:
+                    health.success()
+                return req
+
+            with self.lock:
+                health.failure()
+
+            if attempt >= self.retries:
+                if error:
+                    raise error
+                return req
+
+            if req is not None:
+                # the streamed response is dropped, release its connection
+                req.close()
+
+            delay = self.backoff * (2 ** attempt)
+            remaining = deadline.remaining() if deadline else None
+            if remaining is not None and remaining <= delay:
+                raise DeadlineExceeded("No time left to retry {0}"
+                                       .format(url))
+
+            LOGGER.info("Retrying %s in %.1fs (%s)", url, delay,
+                        error or req.status_code)
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,182 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Gazetteer pre-tagger for threat actors, tools and sectors.
+
+The alias files used by SCIO (aliases.cfg, tools.cfg and sectors.cfg, one
+'Name: alias1,alias2' per line) are compiled once into an Aho-Corasick
+automaton. A document is then scanned in a single pass, independent of
+the number of aliases. Matching is case insensitive, treats any run of
+whitespace as a single space and only accepts matches on word boundaries.
+"""
+
+import collections
+import html.parser
+import logging
+import re
+
+LOGGER = logging.getLogger('root')
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text):
+    """Lower case text and collapse whitespace"""
+
+    return WHITESPACE.sub(" ", text.lower())
+
+
+def parse_alias_file(filename):
+    """Parse a 'Name: alias1,alias2' file. Returns a list of
+    (name, [alias, ...])"""
+
+    res = []
+
+    with open(filename, encoding="utf-8") as alias_file:
+        for line in alias_file:
+            if not line.strip():
+                continue
+            name, _, alias_list = line.partition(":")
+            aliases = [alias.strip() for alias in alias_list.split(",")]
+            res.append((name.strip(), [alias for alias in aliases if alias]))
+
+    return res
+
+
+class Automaton(object):
+    """Aho-Corasick automaton over normalized patterns"""
+
+    def __init__(self):
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+    def add(self, pattern, value):
+        """Add pattern, reporting value when it matches. Must be called
+        before build()"""
+
+        state = 0
+        for char in normalize(pattern):
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+
+        self.out[state].append((len(normalize(pattern)), value))
+
+    def build(self):
+        """Compute failure links"""
+
+        queue = collections.deque(self.goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def search(self, text):
+        """Generate (start, end, value) for every pattern occurrence in the
+        normalized text"""
+
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length, value in self.out[state]:
+                yield end - length, end, value
+
+
+class Gazetteer(object):
+    """Gazetteer tags text with the names (not aliases) of the threat
+    actors, tools and sectors it mentions"""
+
+    def __init__(self, aliases=None, tools=None, sectors=None):
+
+        self.automaton = Automaton()
+
+        for category, filename in (("threat-actors", aliases),
+                                   ("tools", tools),
+                                   ("sectors", sectors)):
+            if not filename:
+                continue
+            entries = parse_alias_file(filename)
+            LOGGER.info("Loaded %d %s from %s", len(entries), category,
+                        filename)
+            for name, aliases_ in entries:
+                for pattern in [name] + aliases_:
+                    self.automaton.add(pattern, (category, name))
+
+        self.automaton.build()
+
+    def tag(self, text):
+        """Return {category: [name, ...]} of everything found in text"""
+
+        text = normalize(text)
+        res = {}
+
+        for start, end, (category, name) in self.automaton.search(text):
+            if start > 0 and text[start - 1].isalnum():
+                continue
+            if end < len(text) and text[end].isalnum():
+                continue
+            res.setdefault(category, set()).add(name)
+
+        return {category: sorted(names) for category, names in res.items()}
+
+
+class TextExtractor(html.parser.HTMLParser):
+    """Collect the text content of a HTML document"""
+
+    def __init__(self):
+
+        super(TextExtractor, self).__init__()
+        self.text = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        """Skip the content of script and style elements"""
+        if tag in ("script", "style"):
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        """End of skipped element"""
+        if tag in ("script", "style") and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        """Collect text"""
+        if not self.skip:
+            self.text.append(data)
+
+
+def html_to_text(html_data):
+    """Return the text content of html_data"""
+
+    extractor = TextExtractor()
+    extractor.feed(html_data)
+    extractor.close()
+
+    return " ".join(extractor.text)
@@ -0,0 +1,153 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Beanstalk priority, TTR and tube policy for jobs put on the 'doc' tube.
+
+Beanstalk hands out jobs with the lowest priority number first. The
+priority grows with the age of the document (creation-date), so fresh
+intel is analysed before a backlog of old documents. Sources can be given
+a fixed offset. The TTR grows with the size of the document, so large
+documents are not handed to a second worker while still being analysed.
+Jobs can be routed to different tubes by size class, so large attachments
+and short articles can be served by separate worker pools.
+
+The policy is read from an optional ini file:
+
+    [priority]
+    base = 1024
+    per-hour = 1
+    unknown = 2147483648
+
+    [sources]
+    US-CERT Alerts = -512
+
+    [ttr]
+    base = 120
+    bytes-per-second = 50000
+    max = 3600
+
+    [tubes]
+    small = doc-small
+    large = doc-large
+    large-size = 1048576
+    large-types = .pdf,.doc,.docx,.xls,.xlsx
+
+Without a [tubes] section (or with empty small/large) everything goes to
+the tube given on the command line.
+"""
+
+from datetime import datetime
+
+import configparser
+import logging
+import os.path
+
+LOGGER = logging.getLogger('root')
+
+MAX_PRIORITY = 2 ** 32 - 1
+
+# tools/submit.py reads the same file, keep its defaults in sync
+DEFAULTS = {
+    "priority": {
+        "base": "1024",
+        "per-hour": "1",
+        "unknown": str(2 ** 31),
+    },
+    "sources": {},
+    "ttr": {
+        "base": "120",
+        "bytes-per-second": "50000",
+        "max": "3600",
+    },
+    "tubes": {
+        "small": "",
+        "large": "",
+        "large-size": str(1024 * 1024),
+        "large-types": ".pdf,.doc,.docx,.xls,.xlsx",
+    },
+}
+
+
+class JobPolicy(object):
+    """JobPolicy computes beanstalk priority and TTR for a document"""
+
+    def __init__(self, config_file=None):
+
+        self.config = configparser.ConfigParser()
+        # source names are case sensitive
+        self.config.optionxform = str
+        self.config.read_dict(DEFAULTS)
+
+        if config_file:
+            LOGGER.info("Reading job policy from %s", config_file)
+            with open(config_file) as policy_file:
+                self.config.read_file(policy_file)
+
+    def priority(self, metadata, now=None):
+        """Priority based on creation-date and source in metadata"""
+
+        section = self.config["priority"]
+
+        try:
+            created = datetime.fromisoformat(metadata["creation-date"])
+        except (KeyError, TypeError, ValueError):
+            priority = section.getint("unknown")
+        else:
+            if created.tzinfo:
+                created = created.astimezone().replace(tzinfo=None)
+            now = now or datetime.now()
+            age = max(0.0, (now - created).total_seconds() / 3600)
+            priority = section.getint("base") + \
+                int(age * section.getfloat("per-hour"))
+
+        source = metadata.get("source")
+        if source and source in self.config["sources"]:
+            priority += self.config["sources"].getint(source)
+
+        return min(MAX_PRIORITY, max(0, priority))
+
+    def ttr(self, size):
+        """TTR in seconds for a document of size bytes"""
+
+        section = self.config["ttr"]
+
+        ttr = section.getint("base") + \
+            size // max(1, section.getint("bytes-per-second"))
+
+        return min(section.getint("max"), ttr)
+
+    def size_class(self, filename, size):
+        """'large' for documents of a large type or size, else 'small'"""
+
+        section = self.config["tubes"]
+
+        large_types = [file_type.strip().lower() for file_type
+                       in section.get("large-types").split(",")
+                       if file_type.strip()]
+
+        if os.path.splitext(filename)[1].lower() in large_types or \
+           size >= section.getint("large-size"):
+            return "large"
+
+        return "small"
+
+    def tube(self, filename, size, default):
+        """Tube for a document of size bytes, default if no tube is
+        configured for its size class"""
+
+        return self.config["tubes"].get(self.size_class(filename, size)) or \
+            default
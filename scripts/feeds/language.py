@@ -0,0 +1,129 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Fast local language identification.
+
+Documents in non-latin scripts are identified by script. Latin script
+documents are identified by counting the most common function words of
+each language. This is good enough to tell English from the other
+languages seen in our feeds, without any external model or service.
+Returns ISO 639-1 codes, or 'und' when the text is too short to tell.
+"""
+
+import re
+
+UNDETERMINED = "und"
+
+MIN_WORDS = 20
+
+WORD = re.compile(r"[^\W\d_]+")
+
+STOPWORDS = {
+    "en": "the of and to in is that for it with as was on are be by this "
+          "from or have an not which at but were has been their they will "
+          "can its",
+    "de": "der die und in den von zu das mit sich des auf für ist im dem "
+          "nicht ein eine als auch es an werden aus er hat dass sie nach "
+          "wird bei",
+    "fr": "de la le et les des en un du une que est pour qui dans a par "
+          "plus pas au sur ne se ce il sont avec ou cette aux",
+    "es": "de la que el en y los del se las por un para con no una su al "
+          "es lo como más pero sus le ha este",
+    "it": "di e il la che in un per del non una sono della le si gli con "
+          "da al dei nel è anche più alla questo delle",
+    "nl": "de van het een en in is op te dat die voor zijn met niet aan er "
+          "om ook als bij door wordt naar maar worden",
+    "pt": "de a o que e do da em um para com não uma os no se na por mais "
+          "as dos como mas ao ele das à seu sua",
+    "pl": "i w na z się nie do to że jest o jak a co po ale tak przez od "
+          "dla są lub oraz może być jego które",
+    "sv": "och i att det som en på är av för med till den har de inte om "
+          "ett men var sig så kan från ska",
+    "no": "og i det som er på en til av for at med har de ikke den vi om "
+          "et var kan fra skal seg eller",
+    "da": "og i at det er en til på som de med for af ikke den har et om "
+          "var kan fra vil eller skal blev",
+    "fi": "ja on ei että se oli hän mutta kun ovat niin myös tai jos sen "
+          "mukaan kanssa joka voi ole sekä",
+}
+
+STOPWORDS = {language: frozenset(words.split())
+             for language, words in STOPWORDS.items()}
+
+# (language, first code point, last code point)
+SCRIPTS = [
+    ("ru", 0x0400, 0x04FF),
+    ("ar", 0x0600, 0x06FF),
+    ("ja", 0x3040, 0x30FF),
+    ("ko", 0xAC00, 0xD7AF),
+    ("zh", 0x4E00, 0x9FFF),
+]
+
+
+def script_language(text):
+    """Return the language of text if most letters are in a non-latin
+    script, otherwise None"""
+
+    counts = dict.fromkeys([language for language, _, _ in SCRIPTS], 0)
+    letters = 0
+
+    for char in text:
+        if not char.isalpha():
+            continue
+        letters += 1
+        code = ord(char)
+        for language, first, last in SCRIPTS:
+            if first <= code <= last:
+                counts[language] += 1
+                break
+
+    if not letters:
+        return None
+
+    # Japanese text mixes kana and kanji
+    if counts["ja"] and counts["ja"] + counts["zh"] > letters / 2:
+        return "ja"
+
+    language, count = max(counts.items(), key=lambda item: item[1])
+    if count > letters / 2:
+        return language
+
+    return None
+
+
+def detect_language(text):
+    """Return the ISO 639-1 code of the language of text, or 'und'"""
+
+    language = script_language(text)
+    if language:
+        return language
+
+    words = WORD.findall(text.lower())
+    if len(words) < MIN_WORDS:
+        return UNDETERMINED
+
+    scores = dict.fromkeys(STOPWORDS, 0)
+    for word in words:
+        for language, stopwords in STOPWORDS.items():
+            if word in stopwords:
+                scores[language] += 1
+
+    language, score = max(scores.items(), key=lambda item: item[1])
+    if score < len(words) / 20:
+        return UNDETERMINED
+
+    return language
@@ -0,0 +1,222 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Append-only manifest journal of downloaded feed entries.
+
+feed_download.py appends one JSON line per new or changed entry.
+upload.py reads the journal from a persisted checkpoint offset, so each
+run only looks at entries added since the previous run.
+
+The journal is split into segments of about DEFAULT_MAX_SEGMENT_SIZE
+bytes, named <filename>.<offset> after the journal offset of their first
+record. Offsets are positions in the whole journal, so a checkpoint stays
+valid across segments. Segments read past by the checkpoint are deleted
+with prune().
+"""
+
+import json
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger('root')
+
+DEFAULT_MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class Manifest(object):
+    """Manifest is an append-only journal with one JSON record per line,
+    stored in rotating segments. Safe to share between threads, but only
+    one process may append."""
+
+    def __init__(self, filename, max_segment_size=DEFAULT_MAX_SEGMENT_SIZE):
+
+        self.filename = filename
+        self.max_segment_size = max_segment_size
+        self.lock = threading.Lock()
+        # (start offset, size) of the segment being appended to
+        self.current = None
+
+    def segment_path(self, start):
+        """Path of the segment starting at journal offset start"""
+
+        return "{0}.{1:016d}".format(self.filename, start)
+
+    def segments(self):
+        """Return the sorted start offsets of the existing segments"""
+
+        directory = os.path.dirname(self.filename) or "."
+        prefix = os.path.basename(self.filename) + "."
+
+        if not os.path.isdir(directory):
+            return []
+
+        return sorted(int(name[len(prefix):])
+                      for name in os.listdir(directory)
+                      if name.startswith(prefix) and
+                      name[len(prefix):].isdigit())
+
+    def recover(self, path):
+        """Truncate a record left half written by a crashed writer from
+        the end of segment path, so the next record starts on a line of
+        its own. Readers never read past an incomplete line, so no
+        checkpoint points into it. Returns the size of the segment"""
+
+        if not os.path.isfile(path):
+            return 0
+
+        with open(path, "rb+") as manifest_file:
+            size = manifest_file.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                block = max(0, end - 64 * 1024)
+                manifest_file.seek(block)
+                newline = manifest_file.read(end - block).rfind(b"\n")
+                if newline >= 0:
+                    end = block + newline + 1
+                    break
+                end = block
+
+            if end < size:
+                LOGGER.warning("Truncating incomplete record at offset %d "
+                               "in %s", end, path)
+                manifest_file.truncate(end)
+
+        return end
+
+    def append(self, record):
+        """Append a record (dict) to the journal. The record is flushed
+        and synced to disk before returning"""
+
+        line = (json.dumps(record) + "\n").encode("utf-8")
+
+        with self.lock:
+            if self.current is None:
+                segments = self.segments()
+                start = segments[-1] if segments else 0
+                self.current = (start,
+                                self.recover(self.segment_path(start)))
+
+            start, size = self.current
+            if size >= self.max_segment_size:
+                start, size = start + size, 0
+                LOGGER.info("Starting manifest segment %s",
+                            self.segment_path(start))
+
+            with open(self.segment_path(start), "ab") as manifest_file:
+                manifest_file.write(line)
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+
+            self.current = (start, size + len(line))
+
+    def read(self, offset=0):
+        """Generate (record, next_offset) for every complete record from
+        journal offset. A partially written last line is left for the
+        next reader"""
+
+        segments = self.segments()
+        if not segments:
+            LOGGER.info("Manifest %s does not exist", self.filename)
+            return
+
+        for index, start in enumerate(segments):
+            if index + 1 < len(segments) and segments[index + 1] <= offset:
+                continue
+
+            if offset < start:
+                LOGGER.warning("Manifest %s offsets %d to %d are gone",
+                               self.filename, offset, start)
+                offset = start
+
+            path = self.segment_path(start)
+            with open(path, "rb") as manifest_file:
+                manifest_file.seek(offset - start)
+                for line in manifest_file:
+                    if not line.endswith(b"\n"):
+                        LOGGER.warning("Incomplete record at offset %d in %s",
+                                       offset, path)
+                        return
+
+                    offset += len(line)
+
+                    try:
+                        record = json.loads(line.decode("utf-8"))
+                    except ValueError as err:
+                        LOGGER.error("Invalid record in %s: %s", path, err)
+                        continue
+
+                    yield record, offset
+
+    def prune(self, offset):
+        """Delete the segments holding only records before journal
+        offset, i.e. read past by a checkpoint. The last segment is
+        always kept"""
+
+        segments = self.segments()
+
+        for start, end in zip(segments, segments[1:]):
+            if end > offset:
+                break
+            path = self.segment_path(start)
+            LOGGER.info("Deleting manifest segment %s", path)
+            os.remove(path)
+
+
+class Checkpoint(object):
+    """Checkpoint persists a single integer position in a file. Writes are
+    atomic, so a crash leaves either the old or the new value. An optional
+    key (any JSON value, e.g. the options of a run) is stored with the
+    position, and a position stored under another key is not loaded"""
+
+    def __init__(self, filename, key=None):
+
+        self.filename = filename
+        self.key = key
+
+    def load(self):
+        """Return the stored position, or 0 if none is stored. Raises
+        ValueError if the position was stored under another key"""
+
+        if not os.path.isfile(self.filename):
+            return 0
+
+        with open(self.filename, "r") as checkpoint_file:
+            lines = checkpoint_file.read().strip().split("\n", 1)
+
+        key = json.loads(lines[1]) if len(lines) > 1 else None
+        if key != self.key:
+            raise ValueError("{0} was stored for {1}, not {2}".format(
+                self.filename, json.dumps(key, sort_keys=True),
+                json.dumps(self.key, sort_keys=True)))
+
+        return int(lines[0]) if lines[0] else 0
+
+    def save(self, position):
+        """Store position"""
+
+        content = str(position)
+        if self.key is not None:
+            content += "\n" + json.dumps(self.key, sort_keys=True)
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as checkpoint_file:
+            checkpoint_file.write(content)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+        os.replace(tmp_filename, self.filename)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Compressed pack file storage for the feed downloader.
+
+Instead of writing one .html and one .meta file per feed entry, entries
+are appended zlib compressed to rotating pack files (pack-NNNNNN.pack). An
+SQLite index (index.sqlite) maps each entry name to its pack file, offset
+and length, so single entries can be read back with one seek.
+
+Exported files are only needed until scio-back has read the job, so
+prune_exports() removes exports older than a given age.
+
+Replacing an entry leaves the old record behind in its pack file.
+compact() moves the live records out of mostly superseded pack files and
+deletes them.
+
+Used as a program, this exports a single entry back to plain files, for
+when scio-back needs a path on disk, and compacts the store:
+
+    packstore.py --store ./pack export "Some_title.html" --dest /tmp/
+    packstore.py --store ./pack compact
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+
+LOGGER = logging.getLogger('root')
+
+# Each record in a pack file is a 4 byte big endian length followed
+# by the zlib compressed payload.
+RECORD_HEADER = struct.Struct(">I")
+
+DEFAULT_MAX_PACK_SIZE = 256 * 1024 * 1024
+
+# compact() rewrites pack files with less than this fraction live data
+DEFAULT_MIN_LIVE_RATIO = 0.5
+
+
+class PackStore(object):
+    """PackStore appends named blobs to compressed pack files and keeps
+    an offset index for random access. Safe to share between threads."""
+
+    def __init__(self, directory, max_pack_size=DEFAULT_MAX_PACK_SIZE):
+        """Open (or create) a pack store in directory"""
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.max_pack_size = max_pack_size
+        self.lock = threading.Lock()
+
+        LOGGER.info("Opening pack store %s", directory)
+        self.conn = sqlite3.connect(os.path.join(directory, "index.sqlite"),
+                                    check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS entry (
+                             name text PRIMARY KEY,
+                             pack integer NOT NULL,
+                             offset integer NOT NULL,
+                             length integer NOT NULL,
+                             sha256 text NOT NULL
+                             );""")
+        self.conn.commit()
+
+        cur = self.conn.execute("SELECT MAX(pack) FROM entry")
+        self.pack = cur.fetchone()[0] or 0
+
+    def pack_path(self, pack):
+        """Return the path of pack file number pack"""
+
+        return os.path.join(self.directory, "pack-{0:06d}.pack".format(pack))
+
+    def append(self, compressed):
+        """Append a compressed record to the current pack file, rotating
+        it when full. Must be called with the lock held. Returns
+        (pack, offset)"""
+
+        path = self.pack_path(self.pack)
+        if os.path.isfile(path) and \
+           os.path.getsize(path) >= self.max_pack_size:
+            self.pack += 1
+            path = self.pack_path(self.pack)
+            LOGGER.info("Rotating to pack file %s", path)
+
+        with open(path, "ab") as pack_file:
+            offset = pack_file.tell()
+            pack_file.write(RECORD_HEADER.pack(len(compressed)))
+            pack_file.write(compressed)
+
+        return self.pack, offset
+
+    def put(self, name, data):
+        """Store data (bytes or str) under name. If the name is already
+        stored with identical content nothing is written. Returns True if
+        the entry was written"""
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        compressed = zlib.compress(data)
+
+        with self.lock:
+            cur = self.conn.execute("SELECT sha256 FROM entry WHERE name = ?",
+                                    (name,))
+            row = cur.fetchone()
+            if row and row[0] == sha256:
+                LOGGER.debug("%s unchanged in pack store", name)
+                return False
+
+            pack, offset = self.append(compressed)
+
+            self.conn.execute("""INSERT OR REPLACE INTO
+                                 entry(name, pack, offset, length, sha256)
+                                 VALUES(?,?,?,?,?)""",
+                              (name, pack, offset, len(compressed), sha256))
+            self.conn.commit()
+
+        LOGGER.debug("Stored %s in pack %d at offset %d", name, pack, offset)
+        return True
+
+    def get(self, name):
+        """Return the content stored under name as bytes, or None if the
+        name is not in the store"""
+
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT pack, offset, length FROM entry WHERE name = ?",
+                (name,))
+            row = cur.fetchone()
+
+        if not row:
+            return None
+
+        pack, offset, length = row
+        with open(self.pack_path(pack), "rb") as pack_file:
+            pack_file.seek(offset + RECORD_HEADER.size)
+            return zlib.decompress(pack_file.read(length))
+
+    def sha256(self, name):
+        """Return the sha256 of the uncompressed content stored under name
+        without reading the pack file, or None if not stored"""
+
+        with self.lock:
+            cur = self.conn.execute("SELECT sha256 FROM entry WHERE name = ?",
+                                    (name,))
+            row = cur.fetchone()
+
+        return row[0] if row else None
+
+    def digests(self, suffix=""):
+        """Return (name, sha256) for all stored names ending in suffix"""
+
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT name, sha256 FROM entry ORDER BY name")
+            return [row for row in cur.fetchall()
+                    if row[0].endswith(suffix)]
+
+    def names(self, suffix=""):
+        """Return all stored names ending in suffix"""
+
+        with self.lock:
+            cur = self.conn.execute("SELECT name FROM entry ORDER BY name")
+            return [row[0] for row in cur.fetchall()
+                    if row[0].endswith(suffix)]
+
+    def compact(self, min_live_ratio=DEFAULT_MIN_LIVE_RATIO):
+        """Move the live records out of every full pack file where less
+        than min_live_ratio of the data is still referenced by the index,
+        and delete it. Records are copied without recompressing. Must not
+        run while another process writes to the store. Returns the number
+        of bytes freed"""
+
+        freed = 0
+
+        with self.lock:
+            cur = self.conn.execute(
+                """SELECT pack, SUM(length + ?) FROM entry
+                   WHERE pack < ? GROUP BY pack""",
+                (RECORD_HEADER.size, self.pack))
+            live = dict(cur.fetchall())
+
+            for pack in range(self.pack):
+                path = self.pack_path(pack)
+                if not os.path.isfile(path):
+                    continue
+
+                size = os.path.getsize(path)
+                if live.get(pack, 0) >= size * min_live_ratio:
+                    continue
+
+                LOGGER.info("Compacting %s (%d of %d bytes live)",
+                            path, live.get(pack, 0), size)
+
+                cur = self.conn.execute(
+                    "SELECT name, offset, length FROM entry WHERE pack = ?",
+                    (pack,))
+                with open(path, "rb") as pack_file:
+                    for name, offset, length in cur.fetchall():
+                        pack_file.seek(offset + RECORD_HEADER.size)
+                        new_pack, new_offset = self.append(
+                            pack_file.read(length))
+                        self.conn.execute(
+                            """UPDATE entry SET pack = ?, offset = ?
+                               WHERE name = ?""",
+                            (new_pack, new_offset, name))
+
+                # the index must point to the copies before the
+                # original is deleted
+                self.conn.commit()
+                os.remove(path)
+                freed += size - live.get(pack, 0)
+
+        LOGGER.info("Compaction freed %d bytes", freed)
+        return freed
+
+    def export(self, name, directory):
+        """Write the entry name to a plain file in directory. Returns the
+        path of the written file"""
+
+        data = self.get(name)
+        if data is None:
+            raise KeyError(name)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        path = os.path.join(directory, os.path.basename(name))
+        with open(path, "wb") as export_file:
+            export_file.write(data)
+
+        LOGGER.debug("Exported %s to %s", name, path)
+        return path
+
+
+def prune_exports(directory, max_age):
+    """Remove files in the export directory not written for max_age
+    seconds. Returns the number of files removed"""
+
+    if not os.path.isdir(directory):
+        return 0
+
+    cutoff = time.time() - max_age
+    removed = 0
+
+    for entry in os.scandir(directory):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError as err:
+            LOGGER.warning("Could not prune %s: %s", entry.path, err)
+
+    LOGGER.info("Pruned %d exports from %s", removed, directory)
+    return removed
+
+
+def init():
+    """initialize argument parser"""
+
+    parser = argparse.ArgumentParser(description="Pack store utility")
+    parser.add_argument("--store", type=str, required=True,
+                        help="Pack store directory")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("list", help="List stored entries")
+
+    export_parser = subparsers.add_parser(
+        "export", help="Export entries to plain files")
+    export_parser.add_argument("names", metavar="NAME", type=str, nargs='+',
+                               help="Entries to export")
+    export_parser.add_argument("--dest", type=str, default=".",
+                               help="Output directory (default: .)")
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="Remove superseded entries from full pack files")
+    compact_parser.add_argument("--min-live", type=float,
+                                default=DEFAULT_MIN_LIVE_RATIO,
+                                help=("Compact pack files with less than " +
+                                      "this fraction live data " +
+                                      "(default: 0.5)"))
+
+    return parser.parse_args()
+
+
+def main(args):
+    """entry point"""
+
+    store = PackStore(args.store)
+
+    if args.command == "list":
+        for name in store.names():
+            print(name)
+    elif args.command == "export":
+        for name in args.names:
+            try:
+                print(store.export(name, args.dest))
+            except KeyError:
+                sys.stderr.write("{0} not found in store\n".format(name))
+    elif args.command == "compact":
+        print("Freed {0} bytes".format(store.compact(args.min_live)))
+    else:
+        sys.stderr.write("No command given (list, export, compact)\n")
+
+
+if __name__ == "__main__":
+    main(init())
@@ -0,0 +1,173 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Profiling support for the feed scripts (--profile).
+
+Each stage of a run is profiled with cProfile, including work done in
+worker threads, and the merged stats are written as <script>-<time>-
+<stage>.prof (readable by pstats, snakeviz, flameprof etc.). From Python
+3.12 cProfile uses sys.monitoring, which allows only one active profiler
+per process but covers every thread, so the whole run is profiled by a
+single profiler and written as <script>-<time>-all.prof. The top memory
+allocations seen by tracemalloc are written to
+<script>-<time>-tracemalloc.txt.
+"""
+
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+LOGGER = logging.getLogger('root')
+
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 50
+
+# One profiler for all threads, see the module docstring
+PROCESS_WIDE = sys.version_info >= (3, 12)
+
+
+class Profiler(object):
+    """Profiler collects cProfile data per stage and tracemalloc
+    statistics. When not enabled all methods are no-ops"""
+
+    def __init__(self, name, directory=".", enabled=False):
+
+        self.name = name
+        self.directory = directory or "."
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.prefix = "{0}-{1}".format(name, time.strftime("%Y%m%dT%H%M%S"))
+        self.profile = None
+
+        if not enabled:
+            return
+
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        if PROCESS_WIDE:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError as err:
+                LOGGER.warning("cProfile not available: %s", err)
+                self.profile = None
+
+    def add(self, stage, profile):
+        """Add a finished profile to stage"""
+
+        with self.lock:
+            self.stages.setdefault(stage, []).append(profile)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Profile the current thread while inside the context. A no-op
+        when the process wide profiler is used, and if another profiler
+        is already active in the thread"""
+
+        if not self.enabled or PROCESS_WIDE:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as err:
+            LOGGER.warning("Not profiling %s: %s", stage, err)
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.add(stage, profile)
+
+    def wrap(self, stage, function):
+        """Return function wrapped so each call is profiled as part of
+        stage, in whatever thread it runs"""
+
+        if not self.enabled or PROCESS_WIDE:
+            return function
+
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            """Run the wrapped function inside a profiled stage"""
+
+            with self.stage(stage):
+                return function(*args, **kwargs)
+
+        return profiled
+
+    def dump(self):
+        """Write the merged stage profiles and tracemalloc statistics"""
+
+        if not self.enabled:
+            return
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        if self.profile:
+            self.profile.disable()
+            self.add("all", self.profile)
+            self.profile = None
+
+        with self.lock:
+            stages = dict(self.stages)
+
+        for stage, profiles in stages.items():
+            stats = pstats.Stats(profiles[0])
+            if profiles[1:]:
+                stats.add(*profiles[1:])
+
+            path = os.path.join(self.directory, "{0}-{1}.prof".format(
+                self.prefix, stage))
+            stats.dump_stats(path)
+            LOGGER.info("Wrote profile for %s (%d threads) to %s",
+                        stage, len(profiles), path)
+
+        snapshot = tracemalloc.take_snapshot()
+        path = os.path.join(self.directory,
+                            "{0}-tracemalloc.txt".format(self.prefix))
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path, "w") as tracemalloc_file:
+            tracemalloc_file.write("current: {0} bytes, peak: {1} bytes\n\n"
+                                   .format(current, peak))
+            for stat in snapshot.statistics("traceback")[:TRACEMALLOC_TOP]:
+                tracemalloc_file.write("{0}\n".format(stat))
+                for line in stat.traceback.format():
+                    tracemalloc_file.write("{0}\n".format(line))
+                tracemalloc_file.write("\n")
+
+        LOGGER.info("Wrote tracemalloc statistics to %s", path)
+
+
+def profile_directory(log):
+    """Directory to store profiles in, next to the log file if any"""
+
+    if log:
+        return os.path.dirname(os.path.abspath(log))
+
+    return "."
@@ -18,11 +18,15 @@ PERFORMANCE OF THIS SOFTWARE.
 ---
 Program to check a directory against a database of cached content (based on hexdigest).
 Any filenames _not_ in the cache is printed on standard out
+
+The digest of every file is stored together with its size, mtime and inode,
+so files that have not changed since the last run are not read again.
 """
 
 from datetime import datetime
 
 import argparse
+import concurrent.futures
 import hashlib
 import os
 import sys
@@ -30,6 +34,9 @@ import sqlite3
 
 import magic
 
+from jobpolicy import JobPolicy
+from profiling import Profiler
+
 
 def initialize_arguments():
     """Initialize the argument parser"""
@@ -41,6 +48,19 @@ def initialize_arguments():
                         help="Store uncached files to cache.")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Verbose error messages.")
+    parser.add_argument("-r", "--route", action="store_true",
+                        help=("Print the tube for each file (by size " +
+                              "class, see --policy) before the path, " +
+                              "separated by a tab."))
+    parser.add_argument("-q", "--queue", type=str, default="doc",
+                        help="Tube when not routed by --policy (default: doc)")
+    parser.add_argument("--policy", type=str,
+                        help="Tube policy (ini file, see jobpolicy.py)")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Subdirectories scanned in parallel (default: 4)")
+    parser.add_argument("--profile", type=str, metavar="PROFILE_DIR",
+                        help=("Write cProfile and tracemalloc statistics " +
+                              "to PROFILE_DIR."))
 
     parser.add_argument("directories", metavar="DIR", type=str, nargs='+',
                         help="Which directories to scan")
@@ -65,36 +85,142 @@ def should_upload(mime, file_name):
     return False
 
 
-def check_directories(args, cache, directories):
+def sha256_file(file_name):
+    """Compute the sha256 of a file without reading it all into memory"""
+
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as content_file:
+        for block in iter(lambda: content_file.read(1024 * 1024), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def scan_directory(args, known, directory, recursive=True):
+    """Walk directory with os.scandir and return a list of
+    (path, size, mtime, inode, sha256, upload, changed) for all files.
+    Files with the same size, mtime and inode as in known are not read;
+    their digest (and upload decision) is taken from known"""
+
+    res = []
+    directories = [directory]
+
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError as err:
+            if args.verbose:
+                sys.stderr.write("{0}\n".format(err))
+            continue
+
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if recursive:
+                        directories.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+
+                stat = entry.stat()
+                key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                cached = known.get(entry.path)
+                if cached and cached[:3] == key:
+                    res.append((entry.path,) + cached + (False,))
+                else:
+                    res.append((entry.path,) + key +
+                               (sha256_file(entry.path), None, True))
+            except OSError as err:
+                if args.verbose:
+                    sys.stderr.write("{0}\n".format(err))
+
+    return res
+
+
+def scan_directories(args, known, directories, profiler):
+    """Scan directories, each immediate subdirectory in parallel. Every
+    scan is profiled as the scan_directory stage of profiler"""
+
+    res = []
+    scan = profiler.wrap("scan_directory", scan_directory)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) \
+            as executor:
+        futures = []
+        for directory in directories:
+            futures.append(executor.submit(scan, args, known, directory,
+                                           False))
+            try:
+                subdirs = [entry.path for entry in os.scandir(directory)
+                           if entry.is_dir()]
+            except OSError as err:
+                if args.verbose:
+                    sys.stderr.write("{0}\n".format(err))
+                continue
+            for subdir in subdirs:
+                futures.append(executor.submit(scan, args, known, subdir))
+
+        for future in futures:
+            res.extend(future.result())
+
+    return res
+
+
+def in_directories(path, directories):
+    """True if path is in (or below) one of directories"""
+
+    return any(path.startswith(os.path.join(directory, ""))
+               for directory in directories)
+
+
+def check_directories(args, cache, directories, profiler):
     """check a list of directories for cached content"""
 
     mime = magic.Magic(mime=True)
+    policy = JobPolicy(args.policy)
 
-    for directory in directories:
-        paths = [os.path.join(directory, x) for x in os.listdir(directory)]
-        files = [path for path in paths if os.path.isfile(path)]
-        subdir = [path for path in paths if os.path.isdir(path)]
+    known = cache.stats()
+    seen = set()
+    changed = []
 
+    for path, size, mtime, inode, sha256, upload, is_changed in \
+            scan_directories(args, known, directories, profiler):
 
-        for file_name in files:
+        seen.add(path)
+
+        if upload is None and cache.contains(sha256):
+            # already submitted, no need to look at the mime type
+            upload = True
+        elif upload is None:
             try:
-                sha256 = hashlib.sha256(open(file_name, "rb").read()).hexdigest()
+                upload = should_upload(mime, path)
             except IOError as err:
                 if args.verbose:
                     sys.stderr.write("{0}\n".format(err))
                 continue
 
-            if not should_upload(mime, file_name):
-                continue
+        if is_changed:
+            changed.append((path, size, mtime, inode, sha256, int(upload)))
+
+        if not upload:
+            continue
 
-            if not cache.contains(sha256):
-                # provide the file path of the uncached file to
-                # stdout for script consumption.
-                print(file_name)
-                if args.add:
-                    cache.append(sha256)
+        if not cache.contains(sha256):
+            # provide the file path of the uncached file to
+            # stdout for script consumption.
+            if args.route:
+                print("{0}\t{1}".format(
+                    policy.tube(path, size, args.queue), path))
+            else:
+                print(path)
+            if args.add:
+                cache.append(sha256)
 
-        check_directories(args, cache, subdir)
+    cache.update_stats(changed)
+    # files deleted (or moved) since the last scan
+    cache.delete_stats([path for path in known
+                        if path not in seen and
+                        in_directories(path, directories)])
 
 
 def main():
@@ -104,7 +230,13 @@ def main():
 
     cache = Cache(args.cache)
 
-    check_directories(args, cache, args.directories)
+    profiler = Profiler("submitcache", args.profile, bool(args.profile))
+
+    try:
+        with profiler.stage("check_directories"):
+            check_directories(args, cache, args.directories, profiler)
+    finally:
+        profiler.dump()
 
 
 class Cache(object):
@@ -123,6 +255,45 @@ class Cache(object):
 	                      description text
                               );""")
 
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS submit_sha256
+                             ON submit(sha256);""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS stat (
+                             path text PRIMARY KEY,
+                             size integer NOT NULL,
+                             mtime integer NOT NULL,
+                             inode integer NOT NULL,
+                             sha256 text NOT NULL,
+                             upload integer NOT NULL
+                             );""")
+        self.conn.commit()
+
+    def stats(self):
+        """Return the stored file stats as a dictionary path ->
+        (size, mtime, inode, sha256, upload)"""
+
+        cur = self.conn.execute(
+            "SELECT path, size, mtime, inode, sha256, upload FROM stat")
+
+        return {row[0]: (row[1], row[2], row[3], row[4], bool(row[5]))
+                for row in cur}
+
+    def update_stats(self, rows):
+        """Store (path, size, mtime, inode, sha256, upload) rows"""
+
+        sql = """INSERT OR REPLACE INTO stat(path, size, mtime, inode,
+                                             sha256, upload)
+                 VALUES (?, ?, ?, ?, ?, ?)"""
+
+        self.conn.executemany(sql, rows)
+        self.conn.commit()
+
+    def delete_stats(self, paths):
+        """Remove the stored stats of paths"""
+
+        self.conn.executemany("DELETE FROM stat WHERE path = ?",
+                              [(path,) for path in paths])
+        self.conn.commit()
+
     def contains(self, sha256_digest):
         """inCach check if a sha256 is allready in the cache"""
 
@@ -3,3 +3,12 @@ CREATE TABLE submit (
 	sha256 text NOT NULL,
 	description text
 );
+CREATE INDEX submit_sha256 ON submit(sha256);
+CREATE TABLE stat (
+	path text PRIMARY KEY,
+	size integer NOT NULL,
+	mtime integer NOT NULL,
+	inode integer NOT NULL,
+	sha256 text NOT NULL,
+	upload integer NOT NULL
+);
@@ -42,6 +42,13 @@ import sqlite3
 import pystalkd.Beanstalkd
 import magic
 
+from gazetteer import Gazetteer, html_to_text
+from jobpolicy import JobPolicy
+from language import UNDETERMINED, detect_language
+from manifest import Checkpoint, Manifest
+from packstore import PackStore, prune_exports
+from profiling import Profiler, profile_directory
+
 LOGGER = logging.getLogger('root')
 
 
@@ -52,15 +59,56 @@ def init():
     parser.add_argument("-l", "--log", type=str,
                         help="Which file to log to (default: stdout)")
     parser.add_argument("-q", "--queue", type=str, default="doc",
-                        help="Which beanstalk queue to use (default: doc)")
+                        help=("Which beanstalk queue to use, unless " +
+                              "routed by --policy (default: doc)"))
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Log level INFO")
     parser.add_argument("--debug", action="store_true",
                         help="Log level DEBUG")
+    parser.add_argument("--profile", action="store_true",
+                        help=("Write cProfile and tracemalloc statistics " +
+                              "next to the log file"))
     parser.add_argument("--cache", type=str, default="upload.sqlite",
                         help=("Which database used for caching allready " +
                               "uploaded files (default: upload.sqlite)"))
-    parser.add_argument("directories", metavar="DIR", type=str, nargs='+',
+    parser.add_argument("--pack", type=str,
+                        help=("Read entries from this pack store instead " +
+                              "of scanning directories"))
+    parser.add_argument("--export", type=str, default="./export/",
+                        help=("Where entries from the pack store are " +
+                              "written before submission (default: " +
+                              "./export/)"))
+    parser.add_argument("--export-max-age", type=float, default=168,
+                        help=("Remove exports older than this many hours, " +
+                              "0 to keep them (default: 168)"))
+    parser.add_argument("--policy", type=str,
+                        help=("Priority/TTR policy (ini file, see " +
+                              "jobpolicy.py). Default: priority by age, " +
+                              "TTR by size"))
+    parser.add_argument("--gazetteer-aliases", type=str,
+                        help=("Pre-tag threat actors from this aliases.cfg " +
+                              "(adds 'pretag' to the meta data)"))
+    parser.add_argument("--gazetteer-tools", type=str,
+                        help="Pre-tag tools from this tools.cfg")
+    parser.add_argument("--gazetteer-sectors", type=str,
+                        help="Pre-tag sectors from this sectors.cfg")
+    parser.add_argument("--languages", type=str, default="en",
+                        help=("Comma separated languages the NLP can " +
+                              "analyse (default: en)"))
+    foreign = parser.add_mutually_exclusive_group()
+    foreign.add_argument("--foreign-queue", type=str,
+                         help=("Beanstalk queue for documents in other " +
+                               "languages (default: same as --queue)"))
+    foreign.add_argument("--skip-foreign", action="store_true",
+                         help="Do not submit documents in other languages")
+    parser.add_argument("--manifest", type=str,
+                        help=("Only handle entries added to this manifest " +
+                              "journal since the last run, instead of " +
+                              "scanning directories"))
+    parser.add_argument("--checkpoint", type=str,
+                        help=("Where the manifest offset is stored " +
+                              "(default: MANIFEST.checkpoint)"))
+    parser.add_argument("directories", metavar="DIR", type=str, nargs='*',
                         help="Which directories to scan")
 
     return parser.parse_args()
@@ -118,45 +166,195 @@ def get_files(directories):
     return res
 
 
-def main(args):
-    """entry point"""
+def get_packed_files(store, submit_cache):
+    """Get all .html entries in a pack store, paired with their parsed
+    .meta entry, as a list of PackedCandidateFile objects. Entries whose
+    content digest is already in the upload cache are skipped without
+    reading the .meta (partial feeds are cached by link, so their .meta
+    is always read)"""
+
+    res = []
+
+    for name, sha256 in store.digests(".html"):
+        if submit_cache.uploaded(sha256):
+            continue
+
+        meta = store.get(name[:-4] + "meta")
+        if meta is None:
+            LOGGER.warning("No meta data for %s (skipping)", name)
+            continue
+
+        res.append(PackedCandidateFile(store, name, json.loads(meta),
+                                       sha256))
+
+    return res
+
+
+def get_manifest_files(manifest, offset, store=None):
+    """Read the manifest journal from offset and generate
+    (CandidateFile, next_offset) for every new entry"""
+
+    for record, next_offset in manifest.read(offset):
+        if record.get("pack"):
+            if not store:
+                LOGGER.error("%s is in a pack store, but no --pack given",
+                             record["html"])
+                continue
+            candidate = PackedCandidateFile(store, record["html"],
+                                            record["metadata"],
+                                            record.get("sha256"))
+        else:
+            candidate = CandidateFile(record["html"], record["metadata"],
+                                      record.get("sha256"))
+
+        yield candidate, next_offset
+
+
+def pretag(gazetteer, filename):
+    """Tag the text of a .html file with the gazetteer"""
+
+    with open(filename, "r", errors="replace") as html_file:
+        return gazetteer.tag(html_to_text(html_file.read()))
+
+
+def document_language(metadata, filename):
+    """Language recorded by feed_download.py, or detected from the file"""
+
+    if metadata.get("language"):
+        return metadata["language"]
+
+    if not filename.endswith(".html"):
+        return UNDETERMINED
+
+    with open(filename, "r", errors="replace") as html_file:
+        return detect_language(html_to_text(html_file.read()))
+
+
+def choose_queue(args, metadata, size):
+    """Return the queue for a document, or None if it should be skipped.
+    Documents where the language could not be determined are treated as
+    supported, and routed by size class (see jobpolicy.py)"""
+
+    language = metadata.get("language", UNDETERMINED)
+    if language == UNDETERMINED or language in args.languages.split(","):
+        return args.job_policy.tube(metadata["filename"], size, args.queue)
+
+    if args.skip_foreign:
+        return None
+
+    return args.foreign_queue or args.queue
+
+
+def submit_candidate(args, submit_cache, bs_conn, candidate):
+    """Submit a candidate to the work queue, unless it is already
+    in the upload cache. Priority and TTR are given by args.job_policy"""
+
+    partial_feed = candidate.metadata.get("partial_feed", False)
+    if partial_feed:
+        LOGGER.info("Partial feed: %s", candidate.filename) # NOQA
+        hexdigest = hashlib.sha256(candidate.metadata["link"].encode("utf-8")).hexdigest()
+        LOGGER.info("Partial feed: %s", hexdigest) # NOQA
+    else:
+        hexdigest = candidate.sha256()
+
+    if not submit_cache.uploaded(hexdigest):
+        LOGGER.debug("submit %s", candidate.filename)
+        submit_cache.insert(candidate.filename, hexdigest,
+                            candidate.metadata.get("creation-date", "NA"))
+        my_metadata = candidate.metadata
+        if candidate.uploadable():
+            my_metadata['filename'] = candidate.path(args.export)
+            size = os.path.getsize(my_metadata['filename'])
+            my_metadata['language'] = document_language(
+                my_metadata, my_metadata['filename'])
+            queue = choose_queue(args, my_metadata, size)
+            if not queue:
+                LOGGER.info("Not uploading %s (language %s)",
+                            candidate.filename, my_metadata['language'])
+                return
+            if args.gazetteer and my_metadata['filename'].endswith(".html"):
+                my_metadata['pretag'] = pretag(args.gazetteer,
+                                               my_metadata['filename'])
+            bs_conn.use(queue)
+            bs_conn.put(json.dumps(my_metadata),
+                        priority=args.job_policy.priority(my_metadata),
+                        ttr=args.job_policy.ttr(size))
+        else:
+            LOGGER.info("Not uploading %s (wrong mimetype)", candidate.filename) # NOQA
+
+
+def upload(args, profiler):
+    """Find new candidates and submit them to the work queue"""
 
     submit_cache = Cache(args.cache)
 
-    candidates = get_files(args.directories)
+    args.job_policy = JobPolicy(args.policy)
 
-    LOGGER.info("Found %d files", len(candidates))
+    if args.gazetteer_aliases or args.gazetteer_tools or \
+       args.gazetteer_sectors:
+        with profiler.stage("gazetteer"):
+            args.gazetteer = Gazetteer(args.gazetteer_aliases,
+                                       args.gazetteer_tools,
+                                       args.gazetteer_sectors)
+    else:
+        args.gazetteer = None
 
-    bs_conn = pystalkd.Beanstalkd.Connection()
-    bs_conn.use(args.queue)
+    store = PackStore(args.pack) if args.pack else None
 
-    for candidate in candidates:
+    if store and args.export_max_age > 0:
+        # scio-back has copied these long since
+        prune_exports(args.export, args.export_max_age * 3600)
 
-        partial_feed = candidate.metadata.get("partial_feed", False)
-        if partial_feed:
-            LOGGER.info("Partial feed: %s", candidate.filename) # NOQA
-            hexdigest = hashlib.sha256(candidate.metadata["link"].encode("utf-8")).hexdigest()
-            LOGGER.info("Partial feed: %s", hexdigest) # NOQA
+    bs_conn = pystalkd.Beanstalkd.Connection()
+
+    if args.manifest:
+        checkpoint = Checkpoint(args.checkpoint or
+                                args.manifest + ".checkpoint")
+        offset = checkpoint.load()
+        LOGGER.info("Reading %s from offset %d", args.manifest, offset)
+
+        manifest = Manifest(args.manifest)
+        count = 0
+        with profiler.stage("manifest"):
+            for candidate, offset in get_manifest_files(manifest, offset,
+                                                        store):
+                submit_candidate(args, submit_cache, bs_conn, candidate)
+                checkpoint.save(offset)
+                count += 1
+
+        manifest.prune(offset)
+        LOGGER.info("Handled %d new manifest entries", count)
+        return
+
+    with profiler.stage("scan"):
+        if store:
+            candidates = get_packed_files(store, submit_cache)
         else:
-            hexdigest = candidate.sha256()
+            candidates = get_files(args.directories)
+
+    LOGGER.info("Found %d files", len(candidates))
 
-        if not submit_cache.uploaded(hexdigest):
-            LOGGER.debug("submit %s", candidate.filename)
-            submit_cache.insert(candidate.filename, hexdigest,
-                                candidate.metadata.get("creation-date", "NA"))
-            my_metadata = candidate.metadata
-            my_metadata['filename'] = candidate.filename
-            if candidate.uploadable():
-                bs_conn.put(json.dumps(my_metadata))
-            else:
-                LOGGER.info("Not uploading %s (wrong mimetype)", candidate.filename) # NOQA
+    with profiler.stage("submit"):
+        for candidate in candidates:
+            submit_candidate(args, submit_cache, bs_conn, candidate)
+
+
+def main(args):
+    """entry point"""
+
+    profiler = Profiler("upload", profile_directory(args.log), args.profile)
+
+    try:
+        upload(args, profiler)
+    finally:
+        profiler.dump()
 
 
 class CandidateFile(object):
     """CandidateFile holds the metadata related to an .html file
     describing when the feed was published etc. """
 
-    def __init__(self, filename, my_metadata):
+    def __init__(self, filename, my_metadata, sha256=None):
 
         LOGGER.debug("Creating CandidateFile %s", filename)
 
@@ -164,7 +362,7 @@ class CandidateFile(object):
         self.metadata = my_metadata
 
         self.mime = magic.Magic(mime=True)
-        self._sha256 = None
+        self._sha256 = sha256
 
     def uploadable(self):
         """Check that the file content is part of a list of valid mime-types"""
@@ -180,6 +378,11 @@ class CandidateFile(object):
         # type starting in with application.
         return self.mime.from_file(self.filename).startswith("application")
 
+    def path(self, directory):  # pylint: disable=W0613
+        """Return a path to the content that scio-back can read"""
+
+        return self.filename
+
     def sha256(self):
         """Compute the sha256 if it not allready computed, return the value"""
 
@@ -192,6 +395,36 @@ class CandidateFile(object):
         return self._sha256
 
 
+class PackedCandidateFile(CandidateFile):
+    """PackedCandidateFile is a CandidateFile stored in a pack store. The
+    content is only written to a plain file when it is submitted"""
+
+    def __init__(self, store, name, my_metadata, sha256=None):
+
+        super(PackedCandidateFile, self).__init__(name, my_metadata, sha256)
+
+        self.filename = name
+        self.store = store
+
+    def uploadable(self):
+        """Entries in the pack store are always .html"""
+
+        return True
+
+    def sha256(self):
+        """Use the digest recorded in the pack store index"""
+
+        if not self._sha256:
+            self._sha256 = self.store.sha256(self.filename)
+
+        return self._sha256
+
+    def path(self, directory):
+        """Export the entry to directory and return the path"""
+
+        return os.path.abspath(self.store.export(self.filename, directory))
+
+
 class Cache(object):
     """Cache handles the caching database logic"""
 
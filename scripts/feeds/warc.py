@@ -0,0 +1,240 @@
+"""Copyright 2019 mnemonic AS <opensource@mnemonic.no>
+
+Permission to use, copy, modify, and/or distribute this software for
+any purpose with or without fee is hereby granted, provided that the
+above copyright notice and this permission notice appear in all
+copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL
+WARRANTIES WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE
+AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL
+DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR
+PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR
+PERFORMANCE OF THIS SOFTWARE.
+
+---
+Record HTTP responses to WARC files and replay them without network.
+
+Every response is written as a WARC/1.0 'response' record, each record
+compressed as a separate gzip member (.warc.gz), which is the layout
+other WARC tools expect. Bodies are stored decoded, so Content-Encoding
+and Transfer-Encoding are dropped from the recorded headers.
+
+For replay all archives in a directory are indexed by (normalized)
+target URI; the newest record for a URI wins.
+"""
+
+from datetime import datetime
+
+import glob
+import gzip
+import logging
+import os
+import threading
+import uuid
+import zlib
+
+import requests
+
+LOGGER = logging.getLogger('root')
+
+DEFAULT_MAX_WARC_SIZE = 1024 * 1024 * 1024
+
+READ_CHUNK = 1024 * 1024
+
+# Headers that do not describe the stored (decoded) body
+DROPPED_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+
+
+def build_response(url, status_code, reason, headers, body):
+    """Build a requests.Response with the content already read, so it
+    behaves like a fetched, non-streamed response"""
+
+    # pylint: disable=protected-access
+    response = requests.models.Response()
+    response.url = url
+    response.status_code = status_code
+    response.reason = reason
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.encoding = requests.utils.get_encoding_from_headers(
+        response.headers)
+    response._content = body
+    response._content_consumed = True
+
+    return response
+
+
+class WarcWriter(object):
+    """WarcWriter appends response records to rotating .warc.gz files
+    in a directory. Safe to share between threads."""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_WARC_SIZE):
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.prefix = "scio-{0}-{1}".format(
+            datetime.utcnow().strftime("%Y%m%dT%H%M%S"), os.getpid())
+        self.serial = 0
+        self.path = None
+
+    def current_path(self):
+        """Return the file to write to, rotating if it is full"""
+
+        if self.path and os.path.getsize(self.path) < self.max_size:
+            return self.path
+
+        self.path = os.path.join(self.directory, "{0}-{1:05d}.warc.gz".format(
+            self.prefix, self.serial))
+        self.serial += 1
+        LOGGER.info("Recording to %s", self.path)
+
+        with open(self.path, "ab") as warc_file:
+            warc_file.write(gzip.compress(self.record(
+                "warcinfo", None, "application/warc-fields",
+                b"software: scio feed_download.py\r\nformat: WARC/1.0\r\n")))
+
+        return self.path
+
+    @staticmethod
+    def record(warc_type, url, content_type, block):
+        """Serialize a single WARC record"""
+
+        headers = [
+            "WARC/1.0",
+            "WARC-Type: {0}".format(warc_type),
+            "WARC-Record-ID: <urn:uuid:{0}>".format(uuid.uuid4()),
+            "WARC-Date: {0}".format(
+                datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")),
+        ]
+        if url:
+            headers.append("WARC-Target-URI: {0}".format(url))
+        headers.append("Content-Type: {0}".format(content_type))
+        headers.append("Content-Length: {0}".format(len(block)))
+
+        return ("\r\n".join(headers) + "\r\n\r\n").encode("utf-8") + \
+            block + b"\r\n\r\n"
+
+    def write_response(self, url, response):
+        """Record a (fully read) requests.Response for url"""
+
+        body = response.content or b""
+
+        http_headers = ["HTTP/1.1 {0} {1}".format(response.status_code,
+                                                  response.reason or "")]
+        for key, value in response.headers.items():
+            if key.lower() not in DROPPED_HEADERS:
+                http_headers.append("{0}: {1}".format(key, value))
+        http_headers.append("Content-Length: {0}".format(len(body)))
+
+        block = ("\r\n".join(http_headers) + "\r\n\r\n").encode(
+            "iso-8859-1", "replace") + body
+
+        data = gzip.compress(self.record(
+            "response", url, "application/http; msgtype=response", block))
+
+        with self.lock:
+            with open(self.current_path(), "ab") as warc_file:
+                warc_file.write(data)
+
+
+def parse_record(data):
+    """Parse a WARC record. Returns (dict(warc headers), block)"""
+
+    head, _, rest = data.partition(b"\r\n\r\n")
+    lines = head.decode("utf-8", "replace").split("\r\n")
+
+    headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", len(rest)))
+
+    return headers, rest[:length]
+
+
+def parse_http_response(url, block):
+    """Parse a recorded HTTP response block into a requests.Response"""
+
+    head, _, body = block.partition(b"\r\n\r\n")
+    lines = head.decode("iso-8859-1").split("\r\n")
+
+    _, status, reason = (lines[0].split(" ", 2) + [""])[:3]
+
+    headers = []
+    for line in lines[1:]:
+        key, _, value = line.partition(":")
+        headers.append((key.strip(), value.strip()))
+
+    return build_response(url, int(status), reason, headers, body)
+
+
+def gzip_members(path, offset=0, limit=None):
+    """Generate (offset, data) for each gzip member in path, starting at
+    offset. At most limit members are read"""
+
+    with open(path, "rb") as warc_file:
+        warc_file.seek(offset)
+        buf = b""
+        count = 0
+        while limit is None or count < limit:
+            decompressor = zlib.decompressobj(31)
+            start = offset
+            output = []
+            while not decompressor.eof:
+                if not buf:
+                    buf = warc_file.read(READ_CHUNK)
+                    if not buf:
+                        if output:
+                            LOGGER.warning("Truncated record at %d in %s",
+                                           start, path)
+                        return
+                output.append(decompressor.decompress(buf))
+                offset += len(buf) - len(decompressor.unused_data)
+                buf = decompressor.unused_data
+            count += 1
+            yield start, b"".join(output)
+
+
+class WarcArchive(object):
+    """WarcArchive indexes the response records of all .warc.gz files in
+    a directory and returns recorded responses by url"""
+
+    def __init__(self, directory, normalize=lambda url: url):
+
+        self.normalize = normalize
+        self.index = {}
+
+        for path in sorted(glob.glob(os.path.join(directory, "*.warc.gz"))):
+            LOGGER.info("Indexing %s", path)
+            for offset, data in gzip_members(path):
+                headers, _ = parse_record(data)
+                if headers.get("warc-type") != "response":
+                    continue
+                url = headers.get("warc-target-uri")
+                if url:
+                    self.index[self.normalize(url)] = (path, offset)
+
+        LOGGER.info("Indexed %d responses in %s", len(self.index), directory)
+
+    def get(self, url):
+        """Return the recorded response for url as a requests.Response,
+        or a 404 response if url was not recorded"""
+
+        location = self.index.get(self.normalize(url))
+        if not location:
+            LOGGER.info("%s not in archive", url)
+            return build_response(url, 404, "Not in archive", {}, b"")
+
+        path, offset = location
+        for _, data in gzip_members(path, offset, limit=1):
+            _, block = parse_record(data)
+            return parse_http_response(url, block)
+
+        return build_response(url, 404, "Not in archive", {}, b"")
@@ -1,14 +1,111 @@
 #!/usr/bin/env python
 
+import argparse
+import configparser
 import json
+import os
+import time
+
 import beanstalkc
-import sys
+
+MAX_PRIORITY = 2 ** 32 - 1
+
+# The same policy file and defaults as scripts/feeds/jobpolicy.py, so
+# documents submitted here and by upload.py are scheduled alike
+POLICY_DEFAULTS = {
+    "priority": {
+        "base": "1024",
+        "per-hour": "1",
+    },
+    "sources": {},
+    "ttr": {
+        "base": "120",
+        "bytes-per-second": "50000",
+        "max": "3600",
+    },
+    "tubes": {
+        "small": "",
+        "large": "",
+        "large-size": str(1024 * 1024),
+        "large-types": ".pdf,.doc,.docx,.xls,.xlsx",
+    },
+}
+
+DEFAULT_TUBE = "doc"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Submit files to scio")
+    parser.add_argument("--policy",
+                        help="Priority/TTR policy ini file, as for upload.py")
+    parser.add_argument("--source",
+                        help="Source of the files, for the [sources] offset")
+    parser.add_argument("--tube",
+                        help=("Tube to use, e.g. as routed by submitcache.py "
+                              "--route (default: by the [tubes] policy, "
+                              "else doc)"))
+    parser.add_argument("files", metavar="FILE", nargs="+")
+    return parser.parse_args()
+
+
+def read_policy(filename):
+    """Read the [priority], [sources], [ttr] and [tubes] sections of the
+    policy file (see scripts/feeds/jobpolicy.py)"""
+    config = configparser.ConfigParser()
+    # source names are case sensitive
+    config.optionxform = str
+    config.read_dict(POLICY_DEFAULTS)
+    if filename:
+        with open(filename) as policy_file:
+            config.read_file(policy_file)
+    return config
+
+
+def priority(args, policy, filename):
+    """Lower is more urgent. Newer files (by mtime) are handled first, so a
+    backlog of old attachments does not delay fresh ones"""
+    section = policy["priority"]
+    age = max(0.0, (time.time() - os.path.getmtime(filename)) / 3600)
+    prio = section.getint("base") + int(age * section.getfloat("per-hour"))
+    if args.source and args.source in policy["sources"]:
+        prio += policy["sources"].getint(args.source)
+    return min(MAX_PRIORITY, max(0, prio))
+
+
+def ttr(policy, filename):
+    """Larger files get more time before beanstalk hands them to another
+    worker"""
+    section = policy["ttr"]
+    size = os.path.getsize(filename)
+    return min(section.getint("max"),
+               section.getint("base") +
+               size // max(1, section.getint("bytes-per-second")))
+
+
+def tube(args, policy, filename):
+    """The tube given on the command line, or the [tubes] policy tube for
+    the size class of the file, as JobPolicy.tube in upload.py"""
+    if args.tube:
+        return args.tube
+    section = policy["tubes"]
+    large_types = [t.strip().lower() for t in
+                   section.get("large-types").split(",") if t.strip()]
+    if os.path.splitext(filename)[1].lower() in large_types or \
+       os.path.getsize(filename) >= section.getint("large-size"):
+        return section.get("large") or DEFAULT_TUBE
+    return section.get("small") or DEFAULT_TUBE
+
+
+args = parse_args()
+policy = read_policy(args.policy)
 
 conn = beanstalkc.Connection()
-conn.use("doc")
 try:
-    for filename in sys.argv[1:]:
+    for filename in args.files:
+        conn.use(tube(args, policy, filename))
         data = {"filename": filename}
-        conn.put(json.dumps(data))
+        conn.put(json.dumps(data),
+                 priority=priority(args, policy, filename),
+                 ttr=ttr(policy, filename))
 finally:
     conn.close()